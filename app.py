@@ -14,10 +14,13 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from concurrent.futures import ThreadPoolExecutor
 from chat_api_handler import ChatAPIHandler
 from utils import get_timestamp, load_config, get_avatar
-from audio_handler import transcribe_audio
-from pdf_handler import add_documents_to_db
+from audio_handler import transcribe_audio_job, transcribe_audio_batch_job, warmup_asr_model
+from pdf_handler import ingest_pdfs_job, delete_session_documents
+from job_queue import job_queue
 from html_templates import css
 from database_operations import (
     get_db_manager,
@@ -25,11 +28,38 @@ from database_operations import (
     DEFAULT_CHAT_MEMORY_LENGTH,
     DEFAULT_RETRIEVED_DOCUMENTS,
     DEFAULT_CHUNK_SIZE,
-    DEFAULT_CHUNK_OVERLAP
+    DEFAULT_CHUNK_OVERLAP,
+    DEFAULT_HISTORY_PAGE_SIZE
 )
-from utils import list_openai_models, list_ollama_models, command
+from utils import command, llm_dispatcher
+from model_catalog import model_catalog, pull_ollama_model_job, supports_multiple_images
+from model_warmup import warmup_manager
+from vectordb_handler import warmup_embeddings
+from retrieval import migrate_chunk_index_job
+import threading
 import sqlite3
 config = load_config()
+batch_config = config.get("batching", {})
+
+job_queue.register("ingest_pdfs", ingest_pdfs_job)
+job_queue.register("transcribe_audio", transcribe_audio_job)
+job_queue.register("transcribe_audio_batch", transcribe_audio_batch_job)
+job_queue.register("pull_model", pull_ollama_model_job)
+job_queue.register("migrate_chunk_index", migrate_chunk_index_job)
+
+JOB_LABELS = {
+    "ingest_pdfs": "Processing pdfs",
+    "transcribe_audio": "Transcribing audio",
+    "transcribe_audio_batch": "Transcribing audio files",
+    "pull_model": "Pulling model",
+    "migrate_chunk_index": "Indexing chunks of older versions"
+}
+
+@st.cache_resource
+def start_chunk_index_migration():
+    """Runs the one time migration of the chunk index in the background instead of in the first search."""
+    if not get_db_manager().document_repo.is_chunk_index_migrated():
+        job_queue.submit("migrate_chunk_index")
 
 def toggle_pdf_chat():
     st.session_state.pdf_chat = True
@@ -47,23 +77,183 @@ def get_session_key():
 def delete_chat_session_history():
     db_manager = get_db_manager()
     db_manager.message_repo.delete_chat_history(st.session_state.session_key)
+    delete_session_documents(st.session_state.session_key)
     st.session_state.session_index_tracker = "new_session"
 
+def reset_history_pages():
+    st.session_state.history_pages = 1
+
+def load_more_history():
+    st.session_state.history_pages += 1
+
+def load_chat_history_pages(db_manager, chat_history_id, pages):
+    """Loads the newest pages of a session with keyset pagination, returns the messages and if older ones exist."""
+    page_size = config.get("chat_history_page_size", DEFAULT_HISTORY_PAGE_SIZE)
+    messages = []
+    before_message_id = None
+    for _ in range(pages):
+        page = db_manager.message_repo.load_messages_page(chat_history_id, before_message_id, page_size)
+        messages = page + messages
+        if len(page) < page_size:
+            return messages, False
+        before_message_id = page[0]["message_id"]
+    return messages, True
+
 def clear_cache():
     st.cache_resource.clear()
 
+def on_pdf_chat_change():
+    clear_cache()
+    if st.session_state.pdf_chat and config["ollama"].get("warmup_embeddings_for_pdf_chat", True):
+        warmup_manager.in_background(warmup_embeddings)
+
+def warmup_selected_model():
+    """Loads a newly selected ollama model in the background, model_tracker remembers the last selection."""
+    selection = (st.session_state.endpoint_to_use, st.session_state.model_to_use)
+    if selection == st.session_state.model_tracker:
+        return
+    st.session_state.model_tracker = selection
+    if selection[0] == "ollama" and selection[1] and config["ollama"].get("warmup_on_select", True):
+        warmup_manager.in_background(warmup_manager.warm_chat_model, selection[1])
+
 def list_model_options():
-    if st.session_state.endpoint_to_use == "ollama":
-        ollama_options = list_ollama_models()
-        if ollama_options == []:
-            st.warning("No ollama models available, please choose one from https://ollama.com/library and pull with /pull <model_name>")
-        return ollama_options
-    elif st.session_state.endpoint_to_use == "openai":
-        return list_openai_models()
+    """Model names from the in-memory catalog, only the first listing of an endpoint is waited for."""
+    endpoint = st.session_state.endpoint_to_use
+    model_options = model_catalog.get_model_names(endpoint, wait_seconds=config.get("model_catalog", {}).get("initial_wait_seconds", 3))
+    error = model_catalog.get_error(endpoint)
+    if error:
+        st.warning(f"Could not list the {endpoint} models: {error}")
+    elif endpoint == "ollama" and model_options == []:
+        st.warning("No ollama models available, please choose one from https://ollama.com/library and pull with /pull <model_name>")
+    return model_options
+
+def describe_model(endpoint, model):
+    metadata = model_catalog.get_metadata(endpoint, model) if model else None
+    if not metadata:
+        return None
+    details = []
+    if metadata["context_length"]:
+        details.append(f"{metadata['context_length']} tokens context")
+    if metadata["size"]:
+        details.append(f"{metadata['size'] / 2**30:.1f} GB")
+    if metadata["multimodal"]:
+        details.append("images")
+    return ", ".join(details) or None
 
 def update_model_options():
     st.session_state.model_options = list_model_options()
 
+def chat_with_live_answer(container, user_input, chat_history, images=None, audio=None, display_text=None, session_key=None):
+    """Streams the answer into the chat container while it is generated and returns the full answer."""
+    if not config.get("stream_responses", True):
+        return ChatAPIHandler.chat(user_input=user_input, chat_history=chat_history, images=images, chat_history_id=session_key)
+
+    with container:
+        # The live turn is removed again after streaming, the history loop renders the saved messages
+        placeholder = st.empty()
+        with placeholder.container():
+            if display_text or images or audio:
+                with st.chat_message(name="user", avatar=get_avatar("user")):
+                    if display_text:
+                        st.write(display_text)
+                    for image in images or []:
+                        st.image(image)
+                    if audio:
+                        st.audio(audio, format="audio/wav")
+            with st.chat_message(name="assistant", avatar=get_avatar("assistant")):
+                llm_answer = st.write_stream(ChatAPIHandler.chat(user_input=user_input, chat_history=chat_history, images=images, stream=True,
+                                                                    chat_history_id=session_key))
+        placeholder.empty()
+    return llm_answer
+
+def chat_concurrently(chat_requests):
+    """Sends independent chat requests in parallel, at most batching.max_concurrent_requests at a time.
+
+    The dispatcher still sends at most llm_dispatcher.max_in_flight requests to one model at once.
+    """
+    script_run_ctx = get_script_run_ctx()
+
+    def attach_script_run_ctx():
+        # The handlers read the selected model from st.session_state, which needs the script context
+        add_script_run_ctx(threading.current_thread(), script_run_ctx)
+
+    with ThreadPoolExecutor(max_workers=batch_config.get("max_concurrent_requests", 4), initializer=attach_script_run_ctx) as executor:
+        return list(executor.map(lambda chat_request: ChatAPIHandler.chat(**chat_request), chat_requests))
+
+def submit_job(job_type, *args, **pending_job):
+    """Queues a background job and remembers what to do with its result once it is finished."""
+    job_id = job_queue.submit(job_type, *args, chat_history_id=pending_job.get("session_key"))
+    st.session_state.pending_jobs.append({"job_id": job_id, "job_type": job_type, **pending_job})
+
+@st.fragment(run_every=config.get("jobs", {}).get("poll_interval_seconds", 2))
+def show_background_jobs():
+    """Shows the progress of the pending jobs and reruns the app once one of them is finished."""
+    job_finished = False
+    for pending_job in st.session_state.pending_jobs:
+        job = job_queue.get_job(pending_job["job_id"])
+        if not job_queue.is_active(job):
+            job_finished = True
+            continue
+        st.progress(job["progress"], text=f"{JOB_LABELS[job['job_type']]}: {job['message'] or job['status']}")
+        st.button("Cancel", key=f"cancel_job_{job['job_id']}", on_click=job_queue.cancel, args=(job["job_id"],))
+    queue_depth = llm_dispatcher.queue_depth()
+    if queue_depth:
+        st.caption(f"{queue_depth} model requests waiting for a free slot")
+    if job_finished:
+        st.rerun()
+
+@st.fragment(run_every=config.get("jobs", {}).get("poll_interval_seconds", 2))
+def show_partial_transcripts():
+    """Shows the transcript of recordings of this session as it grows while they are transcribed."""
+    for pending_job in st.session_state.pending_jobs:
+        if pending_job["job_type"] != "transcribe_audio" or \
+                pending_job["session_key"] not in (st.session_state.session_key, st.session_state.new_session_key):
+            continue
+        job = job_queue.get_job(pending_job["job_id"])
+        if not job_queue.is_active(job) or not job["result"]:
+            continue
+        with st.chat_message(name="user", avatar=get_avatar("user")):
+            st.write(job["result"])
+            st.caption(f"Transcribing, {job['message']}")
+
+def answer_and_save(db_manager, container, session_key, user_text, chat_history):
+    llm_answer = chat_with_live_answer(container, user_text, chat_history, session_key=session_key)
+    db_manager.message_repo.save_message(session_key, "assistant", "text", llm_answer)
+
+def process_finished_jobs(db_manager, container):
+    for pending_job in list(st.session_state.pending_jobs):
+        job = job_queue.get_job(pending_job["job_id"])
+        if job_queue.is_active(job):
+            continue
+        st.session_state.pending_jobs.remove(pending_job)
+        if job is None:
+            continue
+        if job["status"] != "done":
+            st.warning(f"{JOB_LABELS[job['job_type']]} {job['status']}: {job['message']}")
+            continue
+
+        if job["job_type"] == "pull_model":
+            st.toast(job["result"])
+        elif job["job_type"] == "ingest_pdfs":
+            if job["result"]:
+                st.toast(f"Already indexed, skipped: {', '.join(job['result'])}")
+            # A question sent together with the pdfs is answered once they are indexed
+            if pending_job["text"]:
+                answer_and_save(db_manager, container, pending_job["session_key"], pending_job["text"], pending_job["chat_history"])
+        elif job["job_type"] == "transcribe_audio_batch":
+            llm_answers = chat_concurrently([
+                {"user_input": (pending_job["text"] + "\n" + transcription) if pending_job["text"] else transcription,
+                 "chat_history": list(pending_job["chat_history"]),
+                 "chat_history_id": pending_job["session_key"]}
+                for transcription in job["result"]
+            ])
+            with db_manager.unit_of_work():
+                for llm_answer in llm_answers:
+                    db_manager.message_repo.save_message(pending_job["session_key"], "assistant", "text", llm_answer)
+        elif job["job_type"] == "transcribe_audio":
+            user_text = (pending_job["text"] + "\n" + job["result"]) if pending_job["text"] else job["result"]
+            answer_and_save(db_manager, container, pending_job["session_key"], user_text, pending_job["chat_history"])
+
 def main():
     st.title("Multimodal Local Chat App")
     st.write(css, unsafe_allow_html=True)
@@ -75,14 +265,18 @@ def main():
         st.session_state.audio_uploader_key = 0
         st.session_state.pdf_uploader_key = 1
         st.session_state.endpoint_to_use = "ollama"
-        st.session_state.model_options = list_model_options()
         st.session_state.model_tracker = None
+        st.session_state.pending_jobs = []
+        st.session_state.last_audio_input_id = None
+        st.session_state.history_pages = 1
+        warmup_manager.in_background(warmup_asr_model)
 
     if st.session_state.session_key == "new_session" and st.session_state.new_session_key != None:
         st.session_state.session_index_tracker = st.session_state.new_session_key
         st.session_state.new_session_key = None
 
     db_manager = get_db_manager()
+    start_chunk_index_migration()
     
     st.sidebar.title("Chat Sessions")
     chat_sessions = ["new_session"] + db_manager.message_repo.get_all_chat_history_ids()
@@ -93,7 +287,7 @@ def main():
         index = chat_sessions.index(st.session_state.session_index_tracker)
         clear_cache()
 
-    st.sidebar.selectbox("Select a chat session", chat_sessions, key="session_key", index=index)
+    st.sidebar.selectbox("Select a chat session", chat_sessions, key="session_key", index=index, on_change=reset_history_pages)
     
     # Add configuration section
     st.sidebar.title("Configuration")
@@ -101,10 +295,18 @@ def main():
     # Model Settings
     st.sidebar.subheader("Model Configuration")
     api_col, model_col = st.sidebar.columns(2)
-    api_col.selectbox(label="Select an API", options = ["ollama","openai"], key="endpoint_to_use", on_change=update_model_options)
+    api_col.selectbox(label="Select an API", options = ["ollama","openai"], key="endpoint_to_use")
+    # Read from memory on every run, so listings refreshed in the background show up
+    update_model_options()
     model_col.selectbox(label="Select a Model", options = st.session_state.model_options, key="model_to_use")
+    warmup_selected_model()
+    model_description = describe_model(st.session_state.endpoint_to_use, st.session_state.model_to_use)
+    if model_description:
+        model_col.caption(model_description)
     pdf_toggle_col, voice_rec_col = st.sidebar.columns(2)
-    pdf_toggle_col.toggle("PDF Chat", key="pdf_chat", value=False, on_change=clear_cache)
+    pdf_toggle_col.toggle("PDF Chat", key="pdf_chat", value=False, on_change=on_pdf_chat_change)
+    voice_rec_col.toggle("Cache Answers", key="use_response_cache", value=config.get("response_cache", {}).get("enabled", False),
+                         help="Reuse the stored answer of an identical earlier request, turn off for varied answers")
     
     # Add audio input in the sidebar
     audio_input = st.sidebar.audio_input("Record Audio", key="audio_input")
@@ -116,7 +318,7 @@ def main():
     st.sidebar.subheader("Chat History")
     chat_memory_length = st.sidebar.number_input(
         "Number of Previous Messages",
-        value=int(db_manager.settings_repo.get_setting("chat_memory_length", DEFAULT_CHAT_MEMORY_LENGTH)),
+        value=db_manager.settings_repo.get_setting("chat_memory_length", DEFAULT_CHAT_MEMORY_LENGTH),
         key="chat_memory_length",
         on_change=lambda: db_manager.settings_repo.update_setting("chat_memory_length", st.session_state.chat_memory_length)
     )
@@ -125,24 +327,31 @@ def main():
     st.sidebar.subheader("PDF Processing")
     retrieved_docs = st.sidebar.number_input(
         "Number of Retrieved PDF Chunks",
-        value=int(db_manager.settings_repo.get_setting("retrieved_documents", DEFAULT_RETRIEVED_DOCUMENTS)),
+        value=db_manager.settings_repo.get_setting("retrieved_documents", DEFAULT_RETRIEVED_DOCUMENTS),
         key="retrieved_documents",
         on_change=lambda: db_manager.settings_repo.update_setting("retrieved_documents", st.session_state.retrieved_documents)
     )
     chunk_size = st.sidebar.number_input(
         "PDF Chunk Size (characters)",
-        value=int(db_manager.settings_repo.get_setting("chunk_size", DEFAULT_CHUNK_SIZE)),
+        value=db_manager.settings_repo.get_setting("chunk_size", DEFAULT_CHUNK_SIZE),
         key="chunk_size",
         on_change=lambda: db_manager.settings_repo.update_setting("chunk_size", st.session_state.chunk_size)
     )
     chunk_overlap = st.sidebar.number_input(
         "PDF Chunk Overlap (characters)",
-        value=int(db_manager.settings_repo.get_setting("chunk_overlap", DEFAULT_CHUNK_OVERLAP)),
+        value=db_manager.settings_repo.get_setting("chunk_overlap", DEFAULT_CHUNK_OVERLAP),
         key="chunk_overlap",
         on_change=lambda: db_manager.settings_repo.update_setting("chunk_overlap", st.session_state.chunk_overlap)
     )
-    
+
     chat_container = st.container()
+
+    # Finished jobs are taken off the pending list before the fragment checks them, otherwise its rerun would repeat forever
+    process_finished_jobs(db_manager, chat_container)
+
+    # Background Jobs
+    with st.sidebar:
+        show_background_jobs()
     
     # Replace file uploaders with chat_input
     user_input = st.chat_input(
@@ -169,70 +378,95 @@ def main():
                 elif file_type in ["wav", "mp3", "ogg"]:
                     audio_files.append(file)
             
-            # Process PDFs in batch
+            # Process PDFs in batch, a text message is answered once they are added
             if pdf_files:
-                with st.spinner("Processing pdfs..."):
-                    add_documents_to_db(pdf_files)
-                    # If there's a text message, process it after PDFs are added
+                session_key = get_session_key()
+                chat_history = []
+                with db_manager.unit_of_work():
+                    # The documents are scoped to the session, it must exist even if no message is sent with them
+                    db_manager.message_repo.create_session(session_key)
                     if user_input.text:
-                        chat_history = db_manager.message_repo.load_last_k_text_messages(get_session_key(), st.session_state.chat_memory_length)
-                        llm_answer = ChatAPIHandler.chat(user_input=user_input.text, chat_history=chat_history)
-                        db_manager.message_repo.save_message(get_session_key(), "user", "text", user_input.text)
-                        db_manager.message_repo.save_message(get_session_key(), "assistant", "text", llm_answer)
+                        chat_history = db_manager.message_repo.load_last_k_text_messages(session_key, st.session_state.chat_memory_length)
+                        db_manager.message_repo.save_message(session_key, "user", "text", user_input.text)
+                submit_job("ingest_pdfs", pdf_files, st.session_state.chunk_size, st.session_state.chunk_overlap, session_key,
+                           session_key=session_key, text=user_input.text, chat_history=chat_history)
             
-            # Process images
+            # Process images, all of them in one multimodal request if the model takes several images, else one request per image in parallel
             if image_files:
+                images = [image_file.getvalue() for image_file in image_files]
                 with st.spinner("Processing images..."):
-                    for image_file in image_files:
-                        llm_answer = ChatAPIHandler.chat(user_input=user_input.text or "", chat_history=[], image=image_file.getvalue())
-                        db_manager.message_repo.save_message(get_session_key(), "user", "text", user_input.text or "")
-                        db_manager.message_repo.save_message(get_session_key(), "user", "image", image_file.getvalue())
-                        db_manager.message_repo.save_message(get_session_key(), "assistant", "text", llm_answer)
+                    if batch_config.get("batch_images", True) and supports_multiple_images(st.session_state.model_to_use or ""):
+                        llm_answer = chat_with_live_answer(chat_container, user_input.text or "", [], images=images, display_text=user_input.text,
+                                                           session_key=get_session_key())
+                        with db_manager.unit_of_work():
+                            db_manager.message_repo.save_message(get_session_key(), "user", "text", user_input.text or "")
+                            for image in images:
+                                db_manager.message_repo.save_message(get_session_key(), "user", "image", image)
+                            db_manager.message_repo.save_message(get_session_key(), "assistant", "text", llm_answer)
+                    else:
+                        llm_answers = chat_concurrently([{"user_input": user_input.text or "", "chat_history": [], "images": [image],
+                                                         "chat_history_id": get_session_key()} for image in images])
+                        with db_manager.unit_of_work():
+                            for image, llm_answer in zip(images, llm_answers):
+                                db_manager.message_repo.save_message(get_session_key(), "user", "text", user_input.text or "")
+                                db_manager.message_repo.save_message(get_session_key(), "user", "image", image)
+                                db_manager.message_repo.save_message(get_session_key(), "assistant", "text", llm_answer)
             
-            # Process audio files
+            # Process audio files, all of them are transcribed in one batched job and answered once it is finished
             if audio_files:
-                for audio_file in audio_files:
-                    transcribed_audio = transcribe_audio(audio_file.getvalue())
-                    llm_answer = ChatAPIHandler.chat(user_input=(user_input.text or "") + "\n" + transcribed_audio, chat_history=[])
+                with db_manager.unit_of_work():
                     db_manager.message_repo.save_message(get_session_key(), "user", "text", user_input.text or "")
-                    db_manager.message_repo.save_message(get_session_key(), "user", "audio", audio_file.getvalue())
-                    db_manager.message_repo.save_message(get_session_key(), "assistant", "text", llm_answer)
+                    for audio_file in audio_files:
+                        db_manager.message_repo.save_message(get_session_key(), "user", "audio", audio_file.getvalue())
+                submit_job("transcribe_audio_batch", [audio_file.getvalue() for audio_file in audio_files],
+                           session_key=get_session_key(), text=user_input.text or "", chat_history=[])
         
         # Handle text input only if no files were processed
         elif user_input.text:
             if user_input.text.startswith("/"):
-                response = command(user_input.text)
-                db_manager.message_repo.save_message(get_session_key(), "user", "text", user_input.text)
-                db_manager.message_repo.save_message(get_session_key(), "assistant", "text", response)
+                response, job_request = command(user_input.text)
+                if job_request:
+                    submit_job(job_request["job_type"], *job_request["args"], model_name=job_request["model_name"])
+                with db_manager.unit_of_work():
+                    db_manager.message_repo.save_message(get_session_key(), "user", "text", user_input.text)
+                    db_manager.message_repo.save_message(get_session_key(), "assistant", "text", response)
             else:
                 chat_history = db_manager.message_repo.load_last_k_text_messages(get_session_key(), st.session_state.chat_memory_length)
-                llm_answer = ChatAPIHandler.chat(user_input=user_input.text, chat_history=chat_history)
-                db_manager.message_repo.save_message(get_session_key(), "user", "text", user_input.text)
-                db_manager.message_repo.save_message(get_session_key(), "assistant", "text", llm_answer)
+                llm_answer = chat_with_live_answer(chat_container, user_input.text, chat_history, display_text=user_input.text,
+                                                   session_key=get_session_key())
+                with db_manager.unit_of_work():
+                    db_manager.message_repo.save_message(get_session_key(), "user", "text", user_input.text)
+                    db_manager.message_repo.save_message(get_session_key(), "assistant", "text", llm_answer)
 
-    # Handle audio input
-    if audio_input:
-        transcribed_audio = transcribe_audio(audio_input.getvalue())
+    # Handle audio input, the recording stays in the widget across reruns so it is only submitted once
+    if audio_input and audio_input.file_id != st.session_state.last_audio_input_id:
+        st.session_state.last_audio_input_id = audio_input.file_id
         chat_history = db_manager.message_repo.load_last_k_text_messages(get_session_key(), st.session_state.chat_memory_length)
-        llm_answer = ChatAPIHandler.chat(user_input=transcribed_audio, chat_history=chat_history)
         db_manager.message_repo.save_message(get_session_key(), "user", "audio", audio_input.getvalue())
-        db_manager.message_repo.save_message(get_session_key(), "assistant", "text", llm_answer)
+        submit_job("transcribe_audio", audio_input.getvalue(),
+                   session_key=get_session_key(), text="", chat_history=chat_history)
 
     if (st.session_state.session_key != "new_session") != (st.session_state.new_session_key != None):
         with chat_container:
-            chat_history_messages = db_manager.message_repo.load_messages(get_session_key())
+            chat_history_messages, has_older_messages = load_chat_history_pages(db_manager, get_session_key(), st.session_state.history_pages)
+            if has_older_messages:
+                st.button("Load older messages", on_click=load_more_history)
 
             for message in chat_history_messages:
                 with st.chat_message(name=message["sender_type"], avatar=get_avatar(message["sender_type"])):
                     if message["message_type"] == "text":
                         st.write(message["content"])
                     if message["message_type"] == "image":
-                        st.image(message["content"])
+                        st.image(db_manager.media_repo.load_media(message["media_hash"]))
                     if message["message_type"] == "audio":
-                        st.audio(message["content"], format="audio/wav")
+                        st.audio(db_manager.media_repo.load_media(message["media_hash"]), format="audio/wav")
 
         if (st.session_state.session_key == "new_session") and (st.session_state.new_session_key != None):
             st.rerun()
 
+    # Below the chat history, the finished transcript is answered and saved by process_finished_jobs
+    with chat_container:
+        show_partial_transcripts()
+
 if __name__ == "__main__":
     main()
@@ -1,62 +1,352 @@
 from transformers import pipeline
+import numpy as np
+import soundfile
 import librosa
 import io
 from utils import load_config, timeit
-import os
+from collections import OrderedDict
+import threading
+import time
 import subprocess
 config = load_config()
 
-def convert_webm_to_wav_ffmpeg(audio_bytes):
-    # Save the WebM bytes to a file
-    with open("temp_audio.webm", "wb") as f:
-        f.write(audio_bytes)
+class ASRModelRegistry:
+    """Process-wide cache of loaded Whisper pipelines with LRU eviction under a memory budget.
 
-    # Use FFmpeg to convert WebM to WAV
+    Models are loaded outside the registry lock, so a load does not block hits on other models.
+    Room for a model is made before it loads, from its size measured at an earlier load or estimated from its name.
+    """
+
+    # Approximate float32 size of the whisper checkpoints, matched against the model name
+    ESTIMATED_SIZES_MB = {"tiny": 150, "base": 290, "small": 970, "medium": 3060, "large": 6170, "turbo": 3240}
+
+    def __init__(self, max_models=1, memory_budget_mb=None, device="cpu"):
+        self.max_models = max_models
+        self.memory_budget_mb = memory_budget_mb
+        self.device = device
+        self._pipelines = OrderedDict()
+        self._sizes_mb = {}
+        # Models being loaded, with the event set once they are resident or failed and the memory reserved for them
+        self._loading = {}
+        self._reserved_mb = {}
+        # Measured sizes are kept after eviction, for the next load of the model
+        self._known_sizes_mb = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "load_seconds": {}, "last_hit_seconds": 0.0}
+
+    @staticmethod
+    def _estimate_size_mb(pipe):
+        try:
+            return sum(p.numel() * p.element_size() for p in pipe.model.parameters()) / (1024 * 1024)
+        except Exception:
+            return 0.0
+
+    def _expected_size_mb(self, model_name):
+        if model_name in self._known_sizes_mb:
+            return self._known_sizes_mb[model_name]
+        # "turbo" is checked before "large", large-v3-turbo is the smaller model
+        for size_name in sorted(self.ESTIMATED_SIZES_MB, key=lambda name: name != "turbo"):
+            if size_name in model_name:
+                return self.ESTIMATED_SIZES_MB[size_name]
+        return 0.0
+
+    def _evict(self, incoming_mb=0.0):
+        # Called with the lock held, models being loaded count against both limits
+        while self._pipelines and len(self._pipelines) + len(self._loading) >= self.max_models:
+            self._evict_oldest()
+        if self.memory_budget_mb is None:
+            return
+        while self._pipelines and sum(self._sizes_mb.values()) + sum(self._reserved_mb.values()) + incoming_mb > self.memory_budget_mb:
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        model_name, _ = self._pipelines.popitem(last=False)
+        self._sizes_mb.pop(model_name, None)
+        self.stats["evictions"] += 1
+        print(f"Evicted ASR model {model_name}")
+
+    def get(self, model_name=None):
+        model_name = model_name or config["whisper_model"]
+        start_time = time.time()
+        while True:
+            with self._lock:
+                if model_name in self._pipelines:
+                    self._pipelines.move_to_end(model_name)
+                    self.stats["hits"] += 1
+                    self.stats["last_hit_seconds"] = time.time() - start_time
+                    return self._pipelines[model_name]
+                loaded = self._loading.get(model_name)
+                if loaded is None:
+                    self.stats["misses"] += 1
+                    expected_mb = self._expected_size_mb(model_name)
+                    # Make room for the new model before it becomes resident
+                    self._evict(incoming_mb=expected_mb)
+                    self._loading[model_name] = threading.Event()
+                    self._reserved_mb[model_name] = expected_mb
+                    break
+            # Another thread loads the model, its pipeline is shared once it is resident
+            loaded.wait()
+
+        try:
+            pipe = pipeline(
+                task="automatic-speech-recognition",
+                model=model_name,
+                chunk_length_s=30,
+                device=self.device,
+            )
+        except BaseException:
+            with self._lock:
+                self._reserved_mb.pop(model_name, None)
+                self._loading.pop(model_name).set()
+            raise
+        size_mb = self._estimate_size_mb(pipe)
+        with self._lock:
+            self._reserved_mb.pop(model_name, None)
+            loaded = self._loading.pop(model_name)
+            if size_mb > expected_mb:
+                # The estimate was too low, the budget may need another eviction
+                self._evict(incoming_mb=size_mb)
+            self._pipelines[model_name] = pipe
+            self._sizes_mb[model_name] = size_mb
+            self._known_sizes_mb[model_name] = size_mb
+            load_seconds = time.time() - start_time
+            self.stats["load_seconds"][model_name] = load_seconds
+            loaded.set()
+        print(f"Loaded ASR model {model_name} ({size_mb:.0f} MB) in {load_seconds:.4f} seconds")
+        return pipe
+
+    def warmup(self, model_name=None):
+        self.get(model_name)
+
+    def resident_models(self):
+        with self._lock:
+            return list(self._pipelines.keys())
+
+    def clear(self):
+        with self._lock:
+            self._pipelines.clear()
+            self._sizes_mb.clear()
+
+asr_config = config.get("whisper_cache", {})
+batch_config = config.get("batching", {})
+transcription_config = config.get("transcription", {})
+#device = "cuda:0" if torch.cuda.is_available() else "cpu"
+asr_registry = ASRModelRegistry(max_models=asr_config.get("max_models", 1),
+                                memory_budget_mb=asr_config.get("memory_budget_mb"),
+                                device="cpu")
+
+def warmup_asr_model():
+    if asr_config.get("warmup", False):
+        asr_registry.warmup()
+
+# Whisper models expect 16 kHz mono audio
+WHISPER_SAMPLING_RATE = 16000
+
+def sniff_audio_format(audio_bytes):
+    """Guesses the container format from the first bytes, returns None if it is unknown."""
+    if audio_bytes[:4] == b"RIFF" and audio_bytes[8:12] == b"WAVE":
+        return "wav"
+    if audio_bytes[:4] == b"fLaC":
+        return "flac"
+    if audio_bytes[:4] == b"OggS":
+        return "ogg"
+    if audio_bytes[:3] == b"ID3" or (len(audio_bytes) > 1 and audio_bytes[0] == 0xFF and audio_bytes[1] & 0xE0 == 0xE0):
+        return "mp3"
+    if audio_bytes[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"
+    return None
+
+def decode_with_ffmpeg(audio_bytes, sampling_rate):
+    """Pipes the bytes through ffmpeg and reads back mono float32 samples at the given rate."""
     result = subprocess.run(
-        ["ffmpeg", "-fflags", "+igndts", "-i", "temp_audio.webm", "-c:a", "pcm_s16le", "temp_audio.wav"],
+        ["ffmpeg", "-fflags", "+igndts", "-i", "pipe:0", "-f", "f32le", "-acodec", "pcm_f32le",
+         "-ac", "1", "-ar", str(sampling_rate), "pipe:1"],
+        input=audio_bytes,
         capture_output=True
     )
 
     if result.returncode != 0:
         print(result.stderr.decode())
-        raise RuntimeError("FFmpeg failed to convert WebM to WAV")
+        raise RuntimeError("FFmpeg failed to decode the audio")
 
-    # Read the WAV file back into memory
-    with open("temp_audio.wav", "rb") as f:
-        wav_data = f.read()
+    return np.frombuffer(result.stdout, dtype=np.float32)
 
-    wav_io = io.BytesIO(wav_data)
+def decode_with_soundfile(audio_bytes, sampling_rate):
+    audio, sample_rate = soundfile.read(io.BytesIO(audio_bytes), dtype="float32", always_2d=True)
+    audio = audio.mean(axis=1)
+    if sample_rate != sampling_rate:
+        audio = librosa.resample(audio, orig_sr=sample_rate, target_sr=sampling_rate)
+    return audio
 
-    # Clean up the temp files
-    os.remove("temp_audio.webm")
-    os.remove("temp_audio.wav")
+def convert_bytes_to_array(audio_bytes, sampling_rate=WHISPER_SAMPLING_RATE):
+    """Decodes audio bytes in memory to a mono float32 array at the sampling rate of the model.
 
-    return wav_io
+    Formats libsndfile reads natively (wav, flac, ogg) skip ffmpeg, everything else
+    like the webm recordings of the browser is piped through ffmpeg without temp files.
+    """
+    if sniff_audio_format(audio_bytes) in ("wav", "flac", "ogg"):
+        try:
+            return decode_with_soundfile(audio_bytes, sampling_rate)
+        except Exception as e:
+            print(f"Audio error, decoding with ffmpeg instead: {e}")
+    return decode_with_ffmpeg(audio_bytes, sampling_rate)
+
+def iter_ffmpeg_windows(audio_bytes, sampling_rate, window_samples):
+    process = subprocess.Popen(
+        ["ffmpeg", "-loglevel", "error", "-fflags", "+igndts", "-i", "pipe:0", "-f", "f32le", "-acodec", "pcm_f32le",
+         "-ac", "1", "-ar", str(sampling_rate), "pipe:1"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+
+    # Feeding stdin from a thread keeps ffmpeg from blocking on a full stdout pipe
+    def feed_input():
+        try:
+            process.stdin.write(audio_bytes)
+        except BrokenPipeError:
+            pass
+        finally:
+            process.stdin.close()
+    feeder = threading.Thread(target=feed_input, daemon=True)
+    feeder.start()
 
-def convert_bytes_to_array(audio_bytes):
     try:
-        audio_bytes_io = io.BytesIO(audio_bytes)
-        audio, sample_rate = librosa.load(audio_bytes)
-    except Exception as e:
-        print("Audio error, trying to convert to wav.")
-        wav_io = convert_webm_to_wav_ffmpeg(audio_bytes)
-        audio, sample_rate = librosa.load(wav_io)
-
-    print(sample_rate)
-    return audio
+        while True:
+            window = process.stdout.read(window_samples * 4)
+            if not window:
+                break
+            yield np.frombuffer(window[:len(window) - len(window) % 4], dtype=np.float32)
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        feeder.join()
+    if process.returncode != 0:
+        print(process.stderr.read().decode())
+        raise RuntimeError("FFmpeg failed to decode the audio")
+
+def iter_soundfile_windows(sound_file, sampling_rate, window_seconds):
+    with sound_file:
+        window_frames = int(window_seconds * sound_file.samplerate)
+        for block in sound_file.blocks(blocksize=window_frames, dtype="float32", always_2d=True):
+            audio = block.mean(axis=1)
+            if sound_file.samplerate != sampling_rate:
+                audio = librosa.resample(audio, orig_sr=sound_file.samplerate, target_sr=sampling_rate)
+            yield audio
+
+def iter_audio_windows(audio_bytes, sampling_rate=WHISPER_SAMPLING_RATE, window_seconds=30):
+    """Yields the decoded audio in windows, so only one window of samples is in memory at a time."""
+    if sniff_audio_format(audio_bytes) in ("wav", "flac", "ogg"):
+        try:
+            sound_file = soundfile.SoundFile(io.BytesIO(audio_bytes))
+        except Exception as e:
+            print(f"Audio error, decoding with ffmpeg instead: {e}")
+        else:
+            return iter_soundfile_windows(sound_file, sampling_rate, window_seconds)
+    return iter_ffmpeg_windows(audio_bytes, sampling_rate, int(window_seconds * sampling_rate))
+
+def get_audio_duration(audio_bytes):
+    """Duration in seconds read from the container, None if it does not tell without decoding."""
+    if sniff_audio_format(audio_bytes) in ("wav", "flac", "ogg"):
+        try:
+            with soundfile.SoundFile(io.BytesIO(audio_bytes)) as sound_file:
+                return sound_file.frames / sound_file.samplerate
+        except Exception as e:
+            print(f"Audio error, probing with ffprobe instead: {e}")
+    try:
+        result = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", "pipe:0"],
+            input=audio_bytes,
+            capture_output=True
+        )
+        # Browser webm recordings often have no duration in their header, ffprobe prints N/A for them
+        return float(result.stdout.decode().strip())
+    except (OSError, ValueError):
+        return None
+
+def normalize_word(word):
+    return "".join(character for character in word.lower() if character.isalnum())
+
+def count_repeated_words(previous_words, words, max_words):
+    """Finds the words at the start of words that repeat the end of previous_words.
+
+    Returns how many trailing previous words to drop and how many leading words to skip.
+    The last previous word may have been cut by the end of its window, it is dropped if the rest matches.
+    """
+    previous_normalized = [normalize_word(word) for word in previous_words[-(max_words + 1):]]
+    normalized = [normalize_word(word) for word in words[:max_words + 1]]
+    for cut_words, min_match in ((0, 1), (1, 2)):
+        tail = previous_normalized[:len(previous_normalized) - cut_words]
+        for match in range(min(len(tail), len(normalized), max_words), min_match - 1, -1):
+            if tail[-match:] == normalized[:match]:
+                return cut_words, match
+    return 0, 0
+
+def transcribe_audio_stream(audio_bytes):
+    """Transcribes the recording window by window, yields the seconds decoded so far and the transcript so far.
+
+    Every window is transcribed with the last overlap_seconds of the window before it, so words
+    spoken across the boundary are heard whole. The words the overlap repeats are dropped.
+    """
+    pipe = asr_registry.get()
+    sampling_rate = pipe.feature_extractor.sampling_rate
+    overlap_seconds = transcription_config.get("overlap_seconds", 5)
+    overlap_samples = int(overlap_seconds * sampling_rate)
+    # Generous upper bound of the words spoken in the overlap
+    max_overlap_words = int(overlap_seconds * 4) + 2
+    decoded_seconds = 0.0
+    overlap = np.zeros(0, dtype=np.float32)
+    transcript = []
+    for window in iter_audio_windows(audio_bytes, sampling_rate, transcription_config.get("window_seconds", 25)):
+        decoded_seconds += len(window) / sampling_rate
+        audio = np.concatenate([overlap, window]) if len(overlap) else window
+        words = pipe({"raw": audio, "sampling_rate": sampling_rate}, batch_size=1)["text"].split()
+        if len(overlap):
+            cut_words, repeated_words = count_repeated_words(transcript, words, max_overlap_words)
+            transcript = transcript[:len(transcript) - cut_words]
+            words = words[repeated_words:]
+        transcript.extend(words)
+        overlap = audio[-overlap_samples:] if overlap_samples else overlap
+        yield decoded_seconds, " ".join(transcript)
+
+def format_seconds(seconds):
+    return f"{int(seconds // 60)}:{int(seconds % 60):02d}"
+
+def transcribe_audio_job(context, audio_bytes):
+    """Transcribes in windows and reports the transcript so far as partial result, so the chat can show it while the job runs.
+
+    The progress follows the decoded duration, it stays unknown for recordings without a duration in their header.
+    """
+    duration = get_audio_duration(audio_bytes)
+    context.report_progress(0.0, "Transcribing audio")
+    transcript = ""
+    for decoded_seconds, transcript in transcribe_audio_stream(audio_bytes):
+        if duration:
+            context.report_progress(decoded_seconds / duration, f"{format_seconds(decoded_seconds)} of {format_seconds(duration)} transcribed",
+                                    partial_result=transcript)
+        else:
+            context.report_progress(context.progress, f"{format_seconds(decoded_seconds)} transcribed", partial_result=transcript)
+    return transcript
 
 @timeit
-def transcribe_audio(audio_bytes):
-    #device = "cuda:0" if torch.cuda.is_available() else "cpu"
-    device = "cpu"
-    pipe = pipeline(
-        task="automatic-speech-recognition",
-        model=config["whisper_model"],
-        chunk_length_s=30,
-        device=device,
-    )   
-
-    audio_array = convert_bytes_to_array(audio_bytes)
-    prediction = pipe(audio_array, batch_size=1)["text"]
-
-    return prediction
+def transcribe_audio_batch(audio_bytes_list, progress_callback=None):
+    """Transcribes several recordings in batched pipeline passes, returns the texts in input order.
+
+    Only one batch of recordings is decoded at a time, progress_callback(files_done, total_files) is called after every batch.
+    """
+    pipe = asr_registry.get()
+    sampling_rate = pipe.feature_extractor.sampling_rate
+    batch_size = batch_config.get("whisper_batch_size", 8)
+    texts = []
+    for start in range(0, len(audio_bytes_list), batch_size):
+        audio_inputs = [{"raw": convert_bytes_to_array(audio_bytes, sampling_rate), "sampling_rate": sampling_rate}
+                        for audio_bytes in audio_bytes_list[start:start + batch_size]]
+        texts.extend(prediction["text"] for prediction in pipe(audio_inputs, batch_size=batch_size))
+        if progress_callback:
+            progress_callback(len(texts), len(audio_bytes_list))
+    return texts
+
+def transcribe_audio_batch_job(context, audio_bytes_list):
+    def report_progress(files_done, total_files):
+        context.report_progress(files_done / total_files, f"{files_done}/{total_files} audio files transcribed")
+    context.report_progress(0.0, f"Transcribing {len(audio_bytes_list)} audio files")
+    return transcribe_audio_batch(audio_bytes_list, report_progress)
@@ -0,0 +1,57 @@
+"""Measures chat history query latency while the messages table grows.
+
+Run from the repository root: python3 benchmark_chat_history.py [max_messages]
+"""
+from database_operations import DatabaseManager
+import statistics
+import tempfile
+import random
+import time
+import sys
+import os
+
+SESSIONS = 1000
+REPEATS = 50
+
+def median_ms(func):
+    timings = []
+    for _ in range(REPEATS):
+        start_time = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return statistics.median(timings)
+
+def insert_messages(db_manager, count):
+    rows = []
+    for _ in range(count):
+        session = f"session_{random.randrange(SESSIONS):04d}"
+        rows.append((session, random.choice(["user", "assistant"]), "text", "benchmark message " * 10))
+    with db_manager.db_connection.cursor() as cursor:
+        cursor.executemany("INSERT INTO messages (chat_history_id, sender_type, message_type, text_content) VALUES (?, ?, ?, ?)", rows)
+        cursor.executemany("INSERT OR IGNORE INTO chat_sessions (chat_history_id) VALUES (?)", {(row[0],) for row in rows})
+
+def main(max_messages):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_manager = DatabaseManager(os.path.join(tmp_dir, "benchmark.db"))
+        repo = db_manager.message_repo
+        total = 0
+        print(f"{'messages':>10} {'page':>8} {'last_k':>8} {'sessions':>9} {'delete':>8}  (median ms)")
+        size = 10_000
+        while size <= max_messages:
+            insert_messages(db_manager, size - total)
+            total = size
+            page_ms = median_ms(lambda: repo.load_messages_page("session_0001"))
+            last_k_ms = median_ms(lambda: repo.load_last_k_text_messages("session_0001", 10))
+            sessions_ms = median_ms(repo.get_all_chat_history_ids)
+
+            def save_and_delete():
+                for _ in range(20):
+                    repo.save_message("benchmark_delete", "user", "text", "to be deleted")
+                repo.delete_chat_history("benchmark_delete")
+            delete_ms = median_ms(save_and_delete)
+            print(f"{total:>10} {page_ms:>8.3f} {last_k_ms:>8.3f} {sessions_ms:>9.3f} {delete_ms:>8.3f}")
+            size *= 10
+        db_manager.close()
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,56 @@
+"""Measures embedding throughput in chunks per second for the embedding backends.
+
+The chunks come from the pdfs in pdfs/, split with the default chunk settings and embedded
+in batches of pdf_ingestion.embedding_batch_size like an upload. The embedding cache is bypassed.
+The sentence_transformers backend is measured with token budget batching and with fixed batches.
+Run from the repository root: python3 benchmark_embeddings.py [ollama] [sentence_transformers]
+"""
+from database_operations import DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP
+from pdf_handler import get_text_splitter, count_pdf_pages, extract_page_range
+from vectordb_handler import OllamaHTTPEmbeddings
+from local_embeddings import SentenceTransformerEmbeddings
+from utils import load_config
+import glob
+import time
+import sys
+import os
+
+config = load_config()
+BATCH_SIZE = config.get("pdf_ingestion", {}).get("embedding_batch_size", 64)
+
+def load_chunks():
+    splitter = get_text_splitter(DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP)
+    chunks = []
+    for path in sorted(glob.glob(os.path.join("pdfs", "*.pdf"))):
+        with open(path, "rb") as pdf:
+            pdf_bytes = pdf.read()
+        for _, text in extract_page_range(pdf_bytes, 0, count_pdf_pages(pdf_bytes)):
+            chunks.extend(splitter.split_text(text))
+    return chunks
+
+def chunks_per_second(embeddings, chunks):
+    # The first call loads the model and is not timed
+    embeddings.embed_documents(chunks[:8])
+    start_time = time.perf_counter()
+    for start in range(0, len(chunks), BATCH_SIZE):
+        embeddings.embed_documents(chunks[start:start + BATCH_SIZE])
+    return len(chunks) / (time.perf_counter() - start_time)
+
+def get_setups(backends, sentence_transformers_options=None):
+    options = dict(config.get("embeddings", {}).get("sentence_transformers", {}), **(sentence_transformers_options or {}))
+    setups = {}
+    if "ollama" in backends:
+        setups["ollama http"] = OllamaHTTPEmbeddings(model=config["ollama"]["embedding_model"], base_url=config["ollama"]["base_url"])
+    if "sentence_transformers" in backends:
+        setups["local, token budget batches"] = SentenceTransformerEmbeddings(**options)
+        setups["local, fixed batches"] = SentenceTransformerEmbeddings(**dict(options, max_batch_tokens=0))
+    return setups
+
+def main(backends, sentence_transformers_options=None):
+    chunks = load_chunks()
+    print(f"{len(chunks)} chunks of at most {DEFAULT_CHUNK_SIZE} characters, batches of {BATCH_SIZE}")
+    for name, embeddings in get_setups(backends, sentence_transformers_options).items():
+        print(f"{name:>30}: {chunks_per_second(embeddings, chunks):8.1f} chunks/s")
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or ["ollama", "sentence_transformers"])
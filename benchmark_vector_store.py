@@ -0,0 +1,107 @@
+"""Compares recall, query latency, memory and disk size of the vector store options.
+
+Synthetic clustered 768 dimensional vectors (the size of nomic-embed-text) are indexed in
+chroma with its default hnsw parameters, in chroma with a larger search_ef and in the
+quantized store. Every store is searched in a fresh process so its resident memory is measured alone.
+Run from the repository root: python3 benchmark_vector_store.py [vector_count]
+"""
+from quantized_store import QuantizedVectorStore
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import statistics
+import tempfile
+import chromadb
+import time
+import sys
+import os
+
+DIMENSION = 768
+CLUSTERS = 200
+QUERIES = 200
+K = 10
+BATCH_SIZE = 5000
+SETUPS = {
+    "chroma default": {"storage": "chroma", "hnsw": {}},
+    "chroma search_ef=100": {"storage": "chroma", "hnsw": {"hnsw:search_ef": 100}},
+    "quantized int8": {"storage": "quantized", "hnsw": {}},
+}
+
+def make_vectors(count, seed=0):
+    random = np.random.default_rng(seed)
+    centers = random.normal(size=(CLUSTERS, DIMENSION)).astype(np.float32)
+    vectors = centers[random.integers(0, CLUSTERS, count)] + 0.5 * random.normal(size=(count, DIMENSION)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def make_queries(vectors, seed=1):
+    random = np.random.default_rng(seed)
+    queries = vectors[random.integers(0, len(vectors), QUERIES)] + 0.3 * random.normal(size=(QUERIES, DIMENSION)).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+def rss_mb():
+    """Anonymous and file backed resident memory, mapped file pages are page cache the kernel can drop."""
+    rss = {"RssAnon:": 0.0, "RssFile:": 0.0}
+    with open("/proc/self/status") as status:
+        for line in status:
+            fields = line.split()
+            if fields and fields[0] in rss:
+                rss[fields[0]] = int(fields[1]) / 1024
+    return np.array([rss["RssAnon:"], rss["RssFile:"]])
+
+def directory_size_mb(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names) / 2**20
+
+def build(setup, path, count):
+    vectors = make_vectors(count)
+    start_time = time.perf_counter()
+    if setup["storage"] == "quantized":
+        store = QuantizedVectorStore(path, "benchmark", embeddings=None)
+        for start in range(0, count, BATCH_SIZE):
+            ids = [str(index) for index in range(start, min(start + BATCH_SIZE, count))]
+            store.add_vectors(ids, vectors[start:start + BATCH_SIZE], ids, [{} for _ in ids])
+        store.close()
+    else:
+        collection = chromadb.PersistentClient(path).create_collection("benchmark", metadata=setup["hnsw"] or None)
+        for start in range(0, count, BATCH_SIZE):
+            ids = [str(index) for index in range(start, min(start + BATCH_SIZE, count))]
+            collection.add(ids=ids, embeddings=vectors[start:start + BATCH_SIZE].tolist(), documents=ids)
+    return time.perf_counter() - start_time
+
+def search(setup, path, queries):
+    baseline_mb = rss_mb()
+    if setup["storage"] == "quantized":
+        store = QuantizedVectorStore(path, "benchmark", embeddings=None)
+        run_query = lambda query: [document.page_content for document in store.similarity_search_by_vector(query, k=K)]
+    else:
+        collection = chromadb.PersistentClient(path).get_collection("benchmark")
+        run_query = lambda query: collection.query(query_embeddings=[query.tolist()], n_results=K)["ids"][0]
+    results = []
+    timings = []
+    for query in queries:
+        start_time = time.perf_counter()
+        results.append([int(result_id) for result_id in run_query(query)])
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return results, timings, rss_mb() - baseline_mb
+
+def main(count):
+    vectors = make_vectors(count)
+    queries = make_queries(vectors)
+    exact = [set(np.argsort(-(vectors @ query))[:K]) for query in queries]
+    del vectors
+
+    print(f"{count} vectors, {QUERIES} queries, recall@{K} against exact search")
+    print(f"{'store':>22} {'build s':>8} {'recall':>7} {'median ms':>10} {'p95 ms':>7} {'anon MB':>8} {'file MB':>8} {'disk MB':>8}")
+    context = multiprocessing.get_context("spawn")
+    for name, setup in SETUPS.items():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                build_seconds = executor.submit(build, setup, tmp_dir, count).result()
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                results, timings, search_rss_mb = executor.submit(search, setup, tmp_dir, queries).result()
+            recall = statistics.mean(len(exact_ids & set(result)) / K for exact_ids, result in zip(exact, results))
+            p95 = statistics.quantiles(timings, n=20)[-1]
+            print(f"{name:>22} {build_seconds:>8.1f} {recall:>7.3f} {statistics.median(timings):>10.2f} {p95:>7.2f} "
+                  f"{search_rss_mb[0]:>8.1f} {search_rss_mb[1]:>8.1f} {directory_size_mb(tmp_dir):>8.1f}")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
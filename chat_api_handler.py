@@ -1,47 +1,154 @@
-from utils import convert_bytes_to_base64_with_prefix, load_config, convert_bytes_to_base64, convert_ns_to_seconds
-from vectordb_handler import load_vectordb
+from utils import convert_bytes_to_base64_with_prefix, load_config, convert_bytes_to_base64, convert_ns_to_seconds, http_client, llm_dispatcher, get_keep_alive
+from retrieval import retrieve_documents
+from context_builder import ContextBuilder
+from response_cache import ResponseCache
+from model_warmup import load_times
 from dotenv import load_dotenv
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import streamlit as st
-import requests
+import functools
+import json
 import os
 load_dotenv()
 config = load_config()
 openai_api_key = os.getenv('OPENAI_API_KEY')
 
+response_cache_config = config.get("response_cache", {})
+response_cache = ResponseCache(response_cache_config.get("path", "./chat_sessions/response_cache.db"),
+                               ttl_seconds=response_cache_config.get("ttl_seconds", 86400),
+                               max_entries=response_cache_config.get("max_entries", 10000))
+
+def use_response_cache():
+    return st.session_state.get("use_response_cache", response_cache_config.get("enabled", False))
+
+def current_session_id():
+    """The browser session the request comes from, the dispatcher takes waiting requests round robin across them."""
+    script_run_ctx = get_script_run_ctx()
+    return script_run_ctx.session_id if script_run_ctx else None
+
+def dispatch(endpoint, chat_history, stream, stream_call, send_request, data):
+    """Sends a chat request through the llm dispatcher.
+
+    While the response cache is enabled, identical non streamed requests in flight share one answer,
+    otherwise every request is sampled on its own like it would be without the cache.
+    """
+    model = st.session_state["model_to_use"]
+    if stream:
+        return llm_dispatcher.stream(lambda: stream_call(chat_history), (endpoint, model), current_session_id())
+    coalesce_key = ResponseCache.request_hash(endpoint, model, chat_history) if use_response_cache() else None
+    return llm_dispatcher.call(send_request, data, limit_key=(endpoint, model), session_id=current_session_id(),
+                               coalesce_key=coalesce_key)
+
+def cached_response(endpoint, error_prefix):
+    """Serves answers of identical requests from the response cache while it is enabled.
+
+    Answers starting with error_prefix are never stored, streamed answers are stored once fully consumed.
+    """
+    def decorator(api_call):
+        @functools.wraps(api_call)
+        def wrapper(cls, chat_history, stream=False):
+            if not use_response_cache():
+                return api_call(cls, chat_history, stream=stream)
+            request_hash = ResponseCache.request_hash(endpoint, st.session_state["model_to_use"], chat_history)
+            cached = response_cache.get(request_hash)
+            if cached is not None:
+                print(f"Response cache hit: {response_cache.stats()}")
+                return iter([cached]) if stream else cached
+            response = api_call(cls, chat_history, stream=stream)
+            if not stream:
+                if not response.startswith(error_prefix):
+                    response_cache.put(request_hash, response)
+                return response
+            return cache_stream(response, request_hash, error_prefix)
+        return wrapper
+    return decorator
+
+def cache_stream(tokens, request_hash, error_prefix):
+    received = []
+    for token in tokens:
+        received.append(token)
+        yield token
+    # Only reached if the whole answer was consumed
+    response = "".join(received)
+    if response and not response.startswith(error_prefix):
+        response_cache.put(request_hash, response)
+
 class OpenAIChatAPIHandler:
 
     def __init__(self):
         pass
 
     @classmethod
-    def api_call(cls, chat_history):
-
+    @cached_response("openai", "OPENAI ERROR: ")
+    def api_call(cls, chat_history, stream=False):
         data = {
             "model": st.session_state["model_to_use"],
             "messages" : chat_history,
             "stream" : False
         }
+        return dispatch("openai", chat_history, stream, cls.stream_call, cls.send_request, data)
 
+    @classmethod
+    def send_request(cls, data):
+        """Runs on a dispatcher thread, without access to st.session_state."""
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {openai_api_key}"
             }
 
-        response = requests.post(url = "https://api.openai.com/v1/chat/completions", 
-                                 json = data, 
-                                 headers = headers)
+        response = http_client.post(url = "https://api.openai.com/v1/chat/completions", 
+                                    json = data, 
+                                    headers = headers)
         print(response.json())
         json_response = response.json()
         if "error" in json_response.keys():
-            return json_response["error"]["message"]
+            return "OPENAI ERROR: " + json_response["error"]["message"]
         else:
             return response.json()["choices"][0]["message"]["content"]
 
     @classmethod
-    def image_chat(cls, user_input, chat_history, image):
-        chat_history.append({"role": "user", "content": [{"type" : "text","text" : user_input},
-                                                          {"type" : "image_url", "image_url" : {"url" : convert_bytes_to_base64_with_prefix(image)}}]})
-        return cls.api_call(chat_history)
+    def stream_call(cls, chat_history):
+        """Yields content tokens parsed from the server-sent events of a streamed completion."""
+        data = {
+            "model": st.session_state["model_to_use"],
+            "messages" : chat_history,
+            "stream" : True
+        }
+
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {openai_api_key}"
+            }
+
+        with http_client.post(url = "https://api.openai.com/v1/chat/completions",
+                              json = data,
+                              headers = headers,
+                              stream = True) as response:
+            if response.status_code != 200:
+                json_response = response.json()
+                print(json_response)
+                yield "OPENAI ERROR: " + json_response["error"]["message"]
+                return
+            for line in response.iter_lines():
+                line = line.decode("utf-8")
+                if not line.startswith("data: "):
+                    continue
+                payload = line[len("data: "):]
+                if payload == "[DONE]":
+                    break
+                json_chunk = json.loads(payload)
+                if not json_chunk.get("choices"):
+                    continue
+                token = json_chunk["choices"][0]["delta"].get("content")
+                if token:
+                    yield token
+
+    @classmethod
+    def image_chat(cls, user_input, chat_history, images, stream=False):
+        chat_history.append({"role": "user", "content": [{"type" : "text","text" : user_input}] +
+                                                         [{"type" : "image_url", "image_url" : {"url" : convert_bytes_to_base64_with_prefix(image)}}
+                                                          for image in images]})
+        return cls.api_call(chat_history, stream=stream)
 
 class OllamaChatAPIHandler:
 
@@ -49,25 +156,58 @@ class OllamaChatAPIHandler:
         pass
 
     @classmethod
-    def api_call(cls, chat_history):
+    @cached_response("ollama", "OLLAMA ERROR: ")
+    def api_call(cls, chat_history, stream=False):
         data = {
             "model": st.session_state["model_to_use"],
             "messages" : chat_history,
-            "stream" : False
+            "stream" : False,
+            "keep_alive" : get_keep_alive(st.session_state["model_to_use"])
         }
-        response = requests.post(url=config["ollama"]["base_url"] + "/api/chat", 
-                                 json=data)
+        return dispatch("ollama", chat_history, stream, cls.stream_call, cls.send_request, data)
+
+    @classmethod
+    def send_request(cls, data):
+        """Runs on a dispatcher thread, without access to st.session_state."""
+        response = http_client.post(url=config["ollama"]["base_url"] + "/api/chat", 
+                                    json=data)
         print(response.json())
         json_response = response.json()
         if "error" in json_response.keys():
             return "OLLAMA ERROR: " + json_response["error"]
         cls.print_times(json_response)
         return json_response["message"]["content"]
+
+    @classmethod
+    def stream_call(cls, chat_history):
+        """Yields content tokens parsed from the NDJSON lines of a streamed chat response."""
+        data = {
+            "model": st.session_state["model_to_use"],
+            "messages" : chat_history,
+            "stream" : True,
+            "keep_alive" : get_keep_alive(st.session_state["model_to_use"])
+        }
+        with http_client.post(url=config["ollama"]["base_url"] + "/api/chat",
+                              json=data,
+                              stream=True) as response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                json_chunk = json.loads(line)
+                if "error" in json_chunk.keys():
+                    print(json_chunk)
+                    yield "OLLAMA ERROR: " + json_chunk["error"]
+                    return
+                token = json_chunk.get("message", {}).get("content", "")
+                if token:
+                    yield token
+                if json_chunk.get("done", False):
+                    cls.print_times(json_chunk)
         
     @classmethod
-    def image_chat(cls, user_input, chat_history, image):
-        chat_history.append({"role": "user", "content": user_input, "images": [convert_bytes_to_base64(image)]})
-        return cls.api_call(chat_history)
+    def image_chat(cls, user_input, chat_history, images, stream=False):
+        chat_history.append({"role": "user", "content": user_input, "images": [convert_bytes_to_base64(image) for image in images]})
+        return cls.api_call(chat_history, stream=stream)
     
     @classmethod
     def print_times(cls, json_response):        
@@ -81,10 +221,17 @@ class OllamaChatAPIHandler:
         prompt_eval_duration_seconds = convert_ns_to_seconds(prompt_eval_duration_ns)
         eval_duration_seconds = convert_ns_to_seconds(eval_duration_ns)
         
+        cold_start = load_times.record_turn(json_response)
+        load_share = load_duration_seconds / total_duration_seconds if total_duration_seconds else 0
+        
         print(f"Total duration: {total_duration_seconds:.4f} seconds")
-        print(f"Load duration: {load_duration_seconds:.4f} seconds")
+        print(f"Load duration: {load_duration_seconds:.4f} seconds ({load_share:.0%} of total{', cold start' if cold_start else ''})")
         print(f"Prompt eval duration: {prompt_eval_duration_seconds:.4f} seconds")
         print(f"Eval duration: {eval_duration_seconds:.4f} seconds")
+        model_stats = load_times.snapshot().get(json_response.get("model", ""))
+        if model_stats:
+            print(f"Cold starts: {model_stats['cold_starts']} of {model_stats['turns']} turns, "
+                  f"{model_stats['load_seconds']:.2f} of {model_stats['total_seconds']:.2f} seconds spent loading")
 
 class ChatAPIHandler:
 
@@ -92,7 +239,11 @@ class ChatAPIHandler:
         pass
 
     @classmethod
-    def chat(cls, user_input, chat_history, image=None):
+    def chat(cls, user_input, chat_history, images=None, stream=False, chat_history_id=None):
+        """Returns the answer as a string, or a generator of tokens if stream is True.
+
+        All images are sent in one request. In pdf chat the documents of the session chat_history_id are searched.
+        """
         endpoint = st.session_state["endpoint_to_use"]
         print(f"Endpoint to use: {endpoint}")
         print(f"Model to use: {st.session_state['model_to_use']}")
@@ -103,16 +254,21 @@ class ChatAPIHandler:
         else:
             raise ValueError(f"Unknown endpoint: {endpoint}")
 
+        documents = None
         if st.session_state.get("pdf_chat", False):
-            vector_db = load_vectordb()
-            retrieved_documents = vector_db.similarity_search(user_input, k=st.session_state.retrieved_documents)
-            context = "\n".join([item.page_content for item in retrieved_documents])
-            template = f"Answer the user question based on this context: {context}\nUser Question: {user_input}"
-            chat_history.append({"role": "user", "content": template})
-            return handler.api_call(chat_history)
+            retrieved_documents = retrieve_documents(user_input, k=st.session_state.retrieved_documents, chat_history_id=chat_history_id)
+            documents = [item.page_content for item in retrieved_documents]
+
+        context_builder = ContextBuilder(st.session_state["model_to_use"])
+        chat_history, user_content, breakdown = context_builder.build(user_input, chat_history, documents)
+        print(f"Prompt tokens: {breakdown}")
+
+        if documents is not None:
+            chat_history.append({"role": "user", "content": user_content})
+            return handler.api_call(chat_history, stream=stream)
         
-        if image:
-            return handler.image_chat(user_input, chat_history, image)
+        if images:
+            return handler.image_chat(user_content, chat_history, images, stream=stream)
         
-        chat_history.append({"role": "user", "content": user_input})
-        return handler.api_call(chat_history)
\ No newline at end of file
+        chat_history.append({"role": "user", "content": user_content})
+        return handler.api_call(chat_history, stream=stream)
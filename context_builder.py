@@ -0,0 +1,97 @@
+from utils import load_config, lookup_by_prefix
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+config = load_config()
+
+# Tokens added by the chat template around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+PDF_CHAT_TEMPLATE = "Answer the user question based on this context: {context}\nUser Question: {question}"
+
+class ContextBuilder:
+    """Fills the prompt of a model up to its token budget.
+
+    Priority order is system prompt, question, retrieved chunks, recent history.
+    Chunks are kept in retrieval order and history from newest to oldest, whatever
+    does not fit anymore is dropped.
+    """
+
+    def __init__(self, model, budget_config=None):
+        budget_config = budget_config if budget_config is not None else config.get("context_budget", {})
+        self.model = model
+        self.context_window = self._lookup_context_window(model, budget_config)
+        self.budget = max(self.context_window - budget_config.get("reserved_for_answer", 1024), 0)
+        self.chars_per_token = budget_config.get("chars_per_token", 4)
+        self._encoding = self._load_encoding(model)
+
+    @staticmethod
+    def _lookup_context_window(model, budget_config):
+        return lookup_by_prefix(model, budget_config.get("context_windows", {}), budget_config.get("default_context_window", 4096))
+
+    @staticmethod
+    def _load_encoding(model):
+        if tiktoken is None:
+            return None
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return None
+
+    def count_tokens(self, text):
+        """Exact count for models tiktoken knows, otherwise estimated from the character count."""
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        return -(-len(text) // self.chars_per_token)
+
+    def message_tokens(self, message):
+        content = message["content"]
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+        return self.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+    def build(self, question, chat_history, documents=None, system_prompt=None):
+        """Returns the history that fits, the final user message and the token breakdown of the prompt."""
+        breakdown = {"budget": self.budget, "system": 0, "question": 0, "context": 0, "history": 0,
+                     "dropped_chunks": 0, "dropped_messages": 0}
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+            breakdown["system"] = self.count_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+
+        if documents is None:
+            user_content = question
+            breakdown["question"] = self.count_tokens(question) + MESSAGE_OVERHEAD_TOKENS
+        else:
+            breakdown["question"] = self.count_tokens(PDF_CHAT_TEMPLATE.format(context="", question=question)) + MESSAGE_OVERHEAD_TOKENS
+            used = breakdown["system"] + breakdown["question"]
+            context_parts = []
+            for document in documents:
+                # One extra token for the newline joining the chunks
+                document_tokens = self.count_tokens(document) + 1
+                if used + document_tokens > self.budget:
+                    breakdown["dropped_chunks"] += 1
+                    continue
+                context_parts.append(document)
+                used += document_tokens
+                breakdown["context"] += document_tokens
+            user_content = PDF_CHAT_TEMPLATE.format(context="\n".join(context_parts), question=question)
+
+        used = breakdown["system"] + breakdown["question"] + breakdown["context"]
+        kept_history = []
+        for message in reversed(chat_history):
+            tokens = self.message_tokens(message)
+            if used + tokens > self.budget:
+                # Older messages are dropped together with the first one that does not fit
+                breakdown["dropped_messages"] = len(chat_history) - len(kept_history)
+                break
+            kept_history.append(message)
+            used += tokens
+            breakdown["history"] += tokens
+        messages.extend(reversed(kept_history))
+        breakdown["total"] = used
+        return messages, user_content, breakdown
@@ -1,36 +1,100 @@
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any, Optional, Union
+from typing import List, Dict, Any, Optional, Union, Iterator, Set
+from contextlib import contextmanager
 import sqlite3
 import streamlit as st
 from utils import load_config
 import threading
+import hashlib
+import json
+import re
+import time
 
 # Constants
 DEFAULT_CHAT_MEMORY_LENGTH = 2
 DEFAULT_RETRIEVED_DOCUMENTS = 3
 DEFAULT_CHUNK_SIZE = 1024
 DEFAULT_CHUNK_OVERLAP = 50
+DEFAULT_HISTORY_PAGE_SIZE = 50
+DEFAULT_SETTINGS_REFRESH_INTERVAL = 5.0
+# Bumped whenever DatabaseManager._migrate gets a new step
+SCHEMA_VERSION = 2
 
 class DatabaseConnection:
-    """Handles database connection management with thread safety."""
+    """Hands out one sqlite connection per thread and groups writes into transactions."""
     
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, journal_mode: str = "WAL", synchronous: str = "NORMAL",
+                 cache_size_kb: int = 16384, busy_timeout_ms: int = 5000):
         self.db_path = db_path
-        self._connection = None
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size_kb = cache_size_kb
+        self.busy_timeout_ms = busy_timeout_ms
+        self._connections: Dict[threading.Thread, sqlite3.Connection] = {}
+        self._transaction_depth: Dict[threading.Thread, int] = {}
         self._lock = threading.Lock()
 
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_path, check_same_thread=False, timeout=self.busy_timeout_ms / 1000)
+        connection.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+        connection.execute(f"PRAGMA synchronous = {self.synchronous}")
+        # A negative cache_size is interpreted by sqlite as KiB instead of pages
+        connection.execute(f"PRAGMA cache_size = -{int(self.cache_size_kb)}")
+        connection.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        return connection
+
     @property
     def connection(self) -> sqlite3.Connection:
+        thread = threading.current_thread()
         with self._lock:
-            if not self._connection:
-                self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
-            return self._connection
+            if thread not in self._connections:
+                # Streamlit runs scripts on short lived threads, close the connections they left behind
+                for finished_thread in [t for t in self._connections if not t.is_alive()]:
+                    self._connections.pop(finished_thread).close()
+                    self._transaction_depth.pop(finished_thread, None)
+                self._connections[thread] = self._connect()
+            return self._connections[thread]
+
+    @contextmanager
+    def cursor(self) -> Iterator[sqlite3.Cursor]:
+        """Yields a cursor and commits afterwards, unless a surrounding unit of work commits later."""
+        connection = self.connection
+        cursor = connection.cursor()
+        in_unit_of_work = self._transaction_depth.get(threading.current_thread(), 0) > 0
+        try:
+            yield cursor
+            if not in_unit_of_work:
+                connection.commit()
+        except Exception:
+            if not in_unit_of_work:
+                connection.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    @contextmanager
+    def unit_of_work(self) -> Iterator[None]:
+        """Groups all writes of the current thread inside the block into a single transaction."""
+        thread = threading.current_thread()
+        depth = self._transaction_depth.get(thread, 0)
+        self._transaction_depth[thread] = depth + 1
+        try:
+            yield
+            if depth == 0:
+                self.connection.commit()
+        except Exception:
+            if depth == 0:
+                self.connection.rollback()
+            raise
+        finally:
+            self._transaction_depth[thread] = depth
 
     def close(self) -> None:
         with self._lock:
-            if self._connection:
-                self._connection.close()
-                self._connection = None
+            for connection in self._connections.values():
+                connection.close()
+            self._connections.clear()
+            self._transaction_depth.clear()
 
 class BaseRepository(ABC):
     """Abstract base class for all repositories."""
@@ -42,12 +106,52 @@ class BaseRepository(ABC):
     def create_table(self) -> None:
         pass
 
+class MediaRepository(BaseRepository):
+    """Content-addressed store for image and audio bytes, identical uploads are stored once."""
+
+    def create_table(self) -> None:
+        with self.db.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS media (
+                    media_hash TEXT PRIMARY KEY,
+                    content BLOB NOT NULL
+                );
+            """)
+
+    @staticmethod
+    def store(cursor: sqlite3.Cursor, content: bytes) -> str:
+        """Inserts the content with the given cursor, so it is part of the caller's transaction."""
+        media_hash = hashlib.sha256(content).hexdigest()
+        cursor.execute(
+            "INSERT OR IGNORE INTO media (media_hash, content) VALUES (?, ?)",
+            (media_hash, sqlite3.Binary(content))
+        )
+        return media_hash
+
+    def load_media(self, media_hash: str) -> Optional[bytes]:
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT content FROM media WHERE media_hash = ?", (media_hash,))
+            result = cursor.fetchone()
+            return result[0] if result else None
+
+    @staticmethod
+    def delete_unreferenced(cursor: sqlite3.Cursor, media_hashes: List[str]) -> None:
+        """Deletes the given media if no message references it anymore."""
+        cursor.executemany(
+            "DELETE FROM media WHERE media_hash = ? "
+            "AND NOT EXISTS (SELECT 1 FROM messages WHERE messages.media_hash = media.media_hash)",
+            [(media_hash,) for media_hash in media_hashes]
+        )
+
 class MessageRepository(BaseRepository):
     """Handles all message-related database operations."""
+
+    def __init__(self, db_connection: DatabaseConnection, media_repo: MediaRepository):
+        super().__init__(db_connection)
+        self.media_repo = media_repo
     
     def create_table(self) -> None:
-        with self.db.connection as conn:
-            cursor = conn.cursor()
+        with self.db.cursor() as cursor:
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS messages (
                     message_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -55,15 +159,48 @@ class MessageRepository(BaseRepository):
                     sender_type TEXT NOT NULL,
                     message_type TEXT NOT NULL,
                     text_content TEXT,
-                    blob_content BLOB
+                    blob_content BLOB,
+                    media_hash TEXT
                 );
             """)
-            conn.commit()
+            cursor.execute("PRAGMA table_info(messages)")
+            if "media_hash" not in [row[1] for row in cursor.fetchall()]:
+                cursor.execute("ALTER TABLE messages ADD COLUMN media_hash TEXT")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS chat_sessions (
+                    chat_history_id TEXT PRIMARY KEY
+                );
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_history ON messages (chat_history_id, message_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_history_type ON messages (chat_history_id, message_type, message_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_media_hash ON messages (media_hash) WHERE media_hash IS NOT NULL")
+
+    def migrate_inline_blobs(self) -> None:
+        """Moves media stored inline by older versions into the media table."""
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT message_id FROM messages WHERE blob_content IS NOT NULL")
+            for (message_id,) in cursor.fetchall():
+                cursor.execute("SELECT blob_content FROM messages WHERE message_id = ?", (message_id,))
+                media_hash = self.media_repo.store(cursor, cursor.fetchone()[0])
+                cursor.execute(
+                    "UPDATE messages SET media_hash = ?, blob_content = NULL WHERE message_id = ?",
+                    (media_hash, message_id)
+                )
+
+    def backfill_sessions(self) -> None:
+        """Registers the sessions of messages written before the chat_sessions table existed."""
+        with self.db.cursor() as cursor:
+            cursor.execute("INSERT OR IGNORE INTO chat_sessions (chat_history_id) SELECT DISTINCT chat_history_id FROM messages")
+
+    def create_session(self, chat_history_id: str) -> None:
+        """Registers a session before its first message, e.g. for documents uploaded without a question."""
+        with self.db.cursor() as cursor:
+            cursor.execute("INSERT OR IGNORE INTO chat_sessions (chat_history_id) VALUES (?)", (chat_history_id,))
 
     def save_message(self, chat_history_id: str, sender_type: str, 
                     message_type: str, content: Union[str, bytes]) -> None:
-        with self.db.connection as conn:
-            cursor = conn.cursor()
+        with self.db.cursor() as cursor:
+            cursor.execute("INSERT OR IGNORE INTO chat_sessions (chat_history_id) VALUES (?)", (chat_history_id,))
             if message_type == 'text':
                 cursor.execute(
                     'INSERT INTO messages (chat_history_id, sender_type, message_type, text_content) '
@@ -71,34 +208,51 @@ class MessageRepository(BaseRepository):
                     (chat_history_id, sender_type, message_type, content)
                 )
             else:
+                media_hash = self.media_repo.store(cursor, content)
                 cursor.execute(
-                    'INSERT INTO messages (chat_history_id, sender_type, message_type, blob_content) '
+                    'INSERT INTO messages (chat_history_id, sender_type, message_type, media_hash) '
                     'VALUES (?, ?, ?, ?)',
-                    (chat_history_id, sender_type, message_type, sqlite3.Binary(content))
+                    (chat_history_id, sender_type, message_type, media_hash)
                 )
-            conn.commit()
 
     def load_messages(self, chat_history_id: str) -> List[Dict[str, Any]]:
-        with self.db.connection as conn:
-            cursor = conn.cursor()
+        """Media messages only carry their media_hash, the bytes are fetched with MediaRepository.load_media."""
+        with self.db.cursor() as cursor:
             cursor.execute(
-                "SELECT message_id, sender_type, message_type, text_content, blob_content "
-                "FROM messages WHERE chat_history_id = ?",
+                "SELECT message_id, sender_type, message_type, text_content, media_hash "
+                "FROM messages WHERE chat_history_id = ? ORDER BY message_id ASC",
                 (chat_history_id,)
             )
-            return [
-                {
-                    'message_id': row[0],
-                    'sender_type': row[1],
-                    'message_type': row[2],
-                    'content': row[3] if row[2] == 'text' else row[4]
-                }
-                for row in cursor.fetchall()
-            ]
+            return [self._row_to_message(row) for row in cursor.fetchall()]
+
+    def load_messages_page(self, chat_history_id: str, before_message_id: Optional[int] = None,
+                           limit: int = DEFAULT_HISTORY_PAGE_SIZE) -> List[Dict[str, Any]]:
+        """Loads up to limit messages older than before_message_id, the newest ones if it is None.
+
+        Uses keyset pagination on the (chat_history_id, message_id) index, so the cost of a page
+        does not depend on the size of the table or on how far back the page is.
+        """
+        with self.db.cursor() as cursor:
+            cursor.execute(
+                "SELECT message_id, sender_type, message_type, text_content, media_hash "
+                "FROM messages WHERE chat_history_id = ? AND message_id < ? "
+                "ORDER BY message_id DESC LIMIT ?",
+                (chat_history_id, before_message_id if before_message_id is not None else 2**63 - 1, limit)
+            )
+            return [self._row_to_message(row) for row in reversed(cursor.fetchall())]
+
+    @staticmethod
+    def _row_to_message(row: tuple) -> Dict[str, Any]:
+        return {
+            'message_id': row[0],
+            'sender_type': row[1],
+            'message_type': row[2],
+            'content': row[3] if row[2] == 'text' else None,
+            'media_hash': row[4]
+        }
 
     def load_last_k_text_messages(self, chat_history_id: str, k: int) -> List[Dict[str, Any]]:
-        with self.db.connection as conn:
-            cursor = conn.cursor()
+        with self.db.cursor() as cursor:
             cursor.execute("""
                 SELECT message_id, sender_type, message_type, text_content
                 FROM messages
@@ -118,24 +272,47 @@ class MessageRepository(BaseRepository):
             ]
 
     def delete_chat_history(self, chat_history_id: str) -> None:
-        with self.db.connection as conn:
-            cursor = conn.cursor()
+        with self.db.cursor() as cursor:
+            cursor.execute(
+                "SELECT DISTINCT media_hash FROM messages WHERE chat_history_id = ? AND media_hash IS NOT NULL",
+                (chat_history_id,)
+            )
+            media_hashes = [row[0] for row in cursor.fetchall()]
             cursor.execute("DELETE FROM messages WHERE chat_history_id = ?", (chat_history_id,))
-            conn.commit()
+            cursor.execute("DELETE FROM chat_sessions WHERE chat_history_id = ?", (chat_history_id,))
+            self.media_repo.delete_unreferenced(cursor, media_hashes)
 
     def get_all_chat_history_ids(self) -> List[str]:
-        """Get all unique chat history IDs from the messages table."""
-        with self.db.connection as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT DISTINCT chat_history_id FROM messages ORDER BY chat_history_id ASC")
+        """Get all chat history IDs from the chat_sessions table."""
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT chat_history_id FROM chat_sessions ORDER BY chat_history_id ASC")
             return [row[0] for row in cursor.fetchall()]
 
 class SettingsRepository(BaseRepository):
-    """Handles all settings-related database operations."""
+    """Handles all settings-related database operations.
+
+    All settings are loaded with one query and served from memory. Writes go to the
+    database and the cache together and bump a version counter, other processes reload
+    their cache when they see a new version, checked at most every refresh_interval seconds.
+    """
+
+    SETTING_TYPES = {
+        "chat_memory_length": int,
+        "retrieved_documents": int,
+        "chunk_size": int,
+        "chunk_overlap": int,
+    }
+
+    def __init__(self, db_connection: DatabaseConnection, refresh_interval: float = DEFAULT_SETTINGS_REFRESH_INTERVAL):
+        super().__init__(db_connection)
+        self.refresh_interval = refresh_interval
+        self._cache: Dict[str, str] = {}
+        self._version = -1
+        self._last_version_check = 0.0
+        self._lock = threading.Lock()
     
     def create_table(self) -> None:
-        with self.db.connection as conn:
-            cursor = conn.cursor()
+        with self.db.cursor() as cursor:
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS settings (
                     setting_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -143,51 +320,343 @@ class SettingsRepository(BaseRepository):
                     setting_value TEXT NOT NULL
                 );
             """)
-            conn.commit()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS settings_version (
+                    version_id INTEGER PRIMARY KEY CHECK (version_id = 1),
+                    version INTEGER NOT NULL
+                );
+            """)
+            cursor.execute("INSERT OR IGNORE INTO settings_version (version_id, version) VALUES (1, 0)")
+
+    def load_all(self) -> None:
+        with self._lock, self.db.cursor() as cursor:
+            cursor.execute("SELECT version FROM settings_version WHERE version_id = 1")
+            self._version = cursor.fetchone()[0]
+            cursor.execute("SELECT setting_name, setting_value FROM settings")
+            self._cache = dict(cursor.fetchall())
+            self._last_version_check = time.monotonic()
+
+    def _refresh_if_stale(self) -> None:
+        if time.monotonic() - self._last_version_check < self.refresh_interval:
+            return
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT version FROM settings_version WHERE version_id = 1")
+            version = cursor.fetchone()[0]
+        if version != self._version:
+            self.load_all()
+        else:
+            self._last_version_check = time.monotonic()
+
+    def _convert(self, setting_name: str, setting_value: Any, default_value: Any = None) -> Any:
+        setting_type = self.SETTING_TYPES.get(setting_name, type(default_value) if default_value is not None else str)
+        try:
+            return setting_type(setting_value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Setting {setting_name} expects {setting_type.__name__}, got {setting_value!r}")
 
     def get_setting(self, setting_name: str, default_value: Any) -> Any:
-        with self.db.connection as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT setting_value FROM settings WHERE setting_name = ?",
-                (setting_name,)
-            )
-            result = cursor.fetchone()
-            
-            if result:
-                return result[0]
-            
-            self.update_setting(setting_name, default_value)
-            return default_value
+        self._refresh_if_stale()
+        with self._lock:
+            if setting_name not in self._cache:
+                return default_value
+            return self._convert(setting_name, self._cache[setting_name], default_value)
 
     def update_setting(self, setting_name: str, setting_value: Any) -> None:
-        with self.db.connection as conn:
-            cursor = conn.cursor()
+        setting_value = self._convert(setting_name, setting_value, setting_value)
+        with self._lock, self.db.cursor() as cursor:
             cursor.execute(
                 "INSERT OR REPLACE INTO settings (setting_name, setting_value) VALUES (?, ?)",
                 (setting_name, str(setting_value))
             )
-            conn.commit()
+            # The insert holds the write lock, no other process can bump the version before the commit
+            cursor.execute("SELECT version FROM settings_version WHERE version_id = 1")
+            previous_version = cursor.fetchone()[0]
+            cursor.execute("UPDATE settings_version SET version = version + 1 WHERE version_id = 1")
+            # A version bumped by another process since the last refresh means the cache misses its changes
+            missed_changes = previous_version != self._version
+            self._version = previous_version + 1
+            self._cache[setting_name] = str(setting_value)
+        if missed_changes:
+            self.load_all()
+
+class DocumentRepository(BaseRepository):
+    """Keeps track of indexed pdf documents and the ids of their chunks in the vector store.
+
+    Documents belong to the chat session they were uploaded in, documents of the shared
+    scope (indexed without a session) are visible in every session.
+    """
+
+    SHARED_SCOPE = ""
+
+    def create_table(self) -> None:
+        with self.db.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    chat_history_id TEXT NOT NULL DEFAULT '',
+                    document_name TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    page_count INTEGER NOT NULL,
+                    PRIMARY KEY (chat_history_id, document_name)
+                );
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS document_chunks (
+                    chunk_id TEXT PRIMARY KEY,
+                    document_name TEXT NOT NULL,
+                    page_number INTEGER NOT NULL,
+                    chat_history_id TEXT NOT NULL DEFAULT ''
+                );
+            """)
+            # Keyword index of the chunk texts, searched with bm25 next to the vector store
+            cursor.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS document_chunks_fts USING fts5(
+                    chunk_id UNINDEXED,
+                    content,
+                    tokenize = 'porter unicode61'
+                );
+            """)
+            # Set once the chunks of the vector store were registered and tagged, see retrieval.migrate_chunk_index
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS chunk_index_state (
+                    state_id INTEGER PRIMARY KEY CHECK (state_id = 1),
+                    migrated INTEGER NOT NULL
+                );
+            """)
+            cursor.execute("INSERT OR IGNORE INTO chunk_index_state (state_id, migrated) VALUES (1, 0)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents (content_hash)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_document_chunks_session_document ON document_chunks (chat_history_id, document_name)")
+
+    def is_indexed(self, content_hash: str, chat_history_id: str = SHARED_SCOPE) -> bool:
+        """True if the content is indexed in the session or in the shared scope."""
+        with self.db.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM documents WHERE content_hash = ? AND chat_history_id IN (?, ?) LIMIT 1",
+                (content_hash, chat_history_id, self.SHARED_SCOPE)
+            )
+            return cursor.fetchone() is not None
+
+    def get_chunk_ids(self, document_name: str, chat_history_id: str = SHARED_SCOPE) -> List[str]:
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT chunk_id FROM document_chunks WHERE chat_history_id = ? AND document_name = ?",
+                           (chat_history_id, document_name))
+            return [row[0] for row in cursor.fetchall()]
+
+    def get_document_names(self, chat_history_id: str) -> List[str]:
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT document_name FROM documents WHERE chat_history_id = ? ORDER BY document_name",
+                           (chat_history_id,))
+            return [row[0] for row in cursor.fetchall()]
+
+    def save_document(self, document_name: str, content_hash: str, page_count: int,
+                      stale_chunk_ids: List[str], chat_history_id: str = SHARED_SCOPE) -> None:
+        """Records an indexed document and drops the chunks it no longer contains.
+
+        Its current chunks are registered with register_chunks while they are embedded.
+        """
+        with self.db.cursor() as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO documents (chat_history_id, document_name, content_hash, page_count) VALUES (?, ?, ?, ?)",
+                (chat_history_id, document_name, content_hash, page_count)
+            )
+            if stale_chunk_ids:
+                placeholders = ",".join("?" * len(stale_chunk_ids))
+                cursor.execute(f"DELETE FROM document_chunks_fts WHERE chunk_id IN ({placeholders})", stale_chunk_ids)
+                cursor.execute(f"DELETE FROM document_chunks WHERE chunk_id IN ({placeholders})", stale_chunk_ids)
+
+    def delete_document(self, document_name: str, chat_history_id: str = SHARED_SCOPE) -> None:
+        with self.db.cursor() as cursor:
+            self._delete_chunks(cursor, document_name, chat_history_id)
+            cursor.execute("DELETE FROM documents WHERE chat_history_id = ? AND document_name = ?",
+                           (chat_history_id, document_name))
+
+    @staticmethod
+    def _delete_chunks(cursor: sqlite3.Cursor, document_name: str, chat_history_id: str) -> None:
+        cursor.execute(
+            "DELETE FROM document_chunks_fts WHERE chunk_id IN "
+            "(SELECT chunk_id FROM document_chunks WHERE chat_history_id = ? AND document_name = ?)",
+            (chat_history_id, document_name)
+        )
+        cursor.execute("DELETE FROM document_chunks WHERE chat_history_id = ? AND document_name = ?",
+                       (chat_history_id, document_name))
+
+    def is_chunk_index_migrated(self) -> bool:
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT migrated FROM chunk_index_state WHERE state_id = 1")
+            return bool(cursor.fetchone()[0])
+
+    def mark_chunk_index_migrated(self) -> None:
+        with self.db.cursor() as cursor:
+            cursor.execute("UPDATE chunk_index_state SET migrated = 1 WHERE state_id = 1")
+
+    def get_registered_chunk_ids(self) -> Set[str]:
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT chunk_id FROM document_chunks")
+            return {row[0] for row in cursor.fetchall()}
+
+    def register_chunks(self, chunks: List[Dict[str, Any]]) -> None:
+        """Registers chunks added to the vector store, chunks with content are added to the keyword index.
+
+        Chunks are dicts with chunk_id, document_name, page_number, chat_history_id and optionally content.
+        Chunks that are already registered keep their row.
+        """
+        with self.db.cursor() as cursor:
+            cursor.executemany(
+                "INSERT OR IGNORE INTO document_chunks (chunk_id, document_name, page_number, chat_history_id) VALUES (?, ?, ?, ?)",
+                [(chunk["chunk_id"], chunk["document_name"], chunk["page_number"], chunk["chat_history_id"]) for chunk in chunks]
+            )
+            cursor.executemany(
+                "INSERT INTO document_chunks_fts (chunk_id, content) VALUES (?, ?)",
+                [(chunk["chunk_id"], chunk["content"]) for chunk in chunks if chunk.get("content")]
+            )
+
+    def search_chunks(self, query: str, limit: int, chat_history_ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Returns the chunks best matching the words of the query ranked by bm25, only from the given sessions if any."""
+        # Every word is quoted so that characters with a meaning in the fts5 query syntax are matched literally
+        terms = [f'"{term}"' for term in re.findall(r"\w+", query.lower())]
+        if not terms:
+            return []
+        session_filter = ""
+        parameters = [" OR ".join(terms)]
+        if chat_history_ids is not None:
+            session_filter = f"AND c.chat_history_id IN ({','.join('?' * len(chat_history_ids))})"
+            parameters += chat_history_ids
+        with self.db.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT f.chunk_id, c.document_name, c.page_number, c.chat_history_id, f.content,
+                       bm25(document_chunks_fts) AS score
+                FROM document_chunks_fts f
+                JOIN document_chunks c ON c.chunk_id = f.chunk_id
+                WHERE document_chunks_fts MATCH ? {session_filter}
+                ORDER BY score
+                LIMIT ?
+            """, parameters + [limit])
+            return [{"chunk_id": row[0], "document_name": row[1], "page_number": row[2], "chat_history_id": row[3],
+                     "content": row[4], "score": row[5]}
+                    for row in cursor.fetchall()]
+
+class JobRepository(BaseRepository):
+    """Persists the state of background jobs so the UI can poll them."""
+
+    ACTIVE_STATUSES = ("queued", "running")
+
+    def create_table(self) -> None:
+        with self.db.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_type TEXT NOT NULL,
+                    chat_history_id TEXT,
+                    status TEXT NOT NULL,
+                    progress REAL NOT NULL DEFAULT 0,
+                    message TEXT,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)")
+
+    def create_job(self, job_type: str, chat_history_id: Optional[str] = None) -> int:
+        now = time.time()
+        with self.db.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO jobs (job_type, chat_history_id, status, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?)",
+                (job_type, chat_history_id, now, now)
+            )
+            return cursor.lastrowid
+
+    def update_job(self, job_id: int, status: Optional[str] = None, progress: Optional[float] = None,
+                   message: Optional[str] = None, result: Any = None) -> None:
+        """Updates the given fields, the result is stored as json."""
+        fields = {"updated_at": time.time()}
+        if status is not None:
+            fields["status"] = status
+        if progress is not None:
+            fields["progress"] = progress
+        if message is not None:
+            fields["message"] = message
+        if result is not None:
+            fields["result"] = json.dumps(result)
+        with self.db.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE job_id = ?",
+                list(fields.values()) + [job_id]
+            )
+
+    def get_job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with self.db.cursor() as cursor:
+            cursor.execute(
+                "SELECT job_id, job_type, chat_history_id, status, progress, message, result, created_at, updated_at "
+                "FROM jobs WHERE job_id = ?",
+                (job_id,)
+            )
+            row = cursor.fetchone()
+            if not row:
+                return None
+            return {
+                'job_id': row[0],
+                'job_type': row[1],
+                'chat_history_id': row[2],
+                'status': row[3],
+                'progress': row[4],
+                'message': row[5],
+                'result': json.loads(row[6]) if row[6] is not None else None,
+                'created_at': row[7],
+                'updated_at': row[8]
+            }
+
+    def fail_interrupted_jobs(self) -> None:
+        """Jobs of a previous process cannot be resumed because their input only lived in memory."""
+        with self.db.cursor() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET status = 'failed', message = 'Interrupted by a restart', updated_at = ? "
+                "WHERE status IN ('queued', 'running')",
+                (time.time(),)
+            )
 
 class DatabaseManager:
     """Main database manager that coordinates all database operations."""
     
-    def __init__(self, db_path: str):
-        self.db_connection = DatabaseConnection(db_path)
-        self.message_repo = MessageRepository(self.db_connection)
+    def __init__(self, db_path: str, sqlite_config: Optional[Dict[str, Any]] = None):
+        self.db_connection = DatabaseConnection(db_path, **(sqlite_config or {}))
+        self.media_repo = MediaRepository(self.db_connection)
+        self.message_repo = MessageRepository(self.db_connection, self.media_repo)
         self.settings_repo = SettingsRepository(self.db_connection)
+        self.document_repo = DocumentRepository(self.db_connection)
+        self.job_repo = JobRepository(self.db_connection)
         self._initialize_database()
 
     def _initialize_database(self) -> None:
+        self.media_repo.create_table()
         self.message_repo.create_table()
         self.settings_repo.create_table()
+        self.document_repo.create_table()
+        self.job_repo.create_table()
+        self._migrate()
+        self.settings_repo.load_all()
+
+    def _migrate(self) -> None:
+        """Runs the data migrations the database has not seen yet, tracked in PRAGMA user_version."""
+        with self.db_connection.cursor() as cursor:
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self.message_repo.migrate_inline_blobs()
+        if version < 2:
+            self.message_repo.backfill_sessions()
+        if version < SCHEMA_VERSION:
+            with self.db_connection.cursor() as cursor:
+                cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def unit_of_work(self):
+        """Context manager that saves everything written inside it in one transaction."""
+        return self.db_connection.unit_of_work()
 
     def close(self) -> None:
         self.db_connection.close()
 
 # Initialize the database manager with configuration
 config = load_config()
-db_manager = DatabaseManager(config["chat_sessions_database_path"])
+db_manager = DatabaseManager(config["chat_sessions_database_path"], config.get("sqlite"))
 
 # Streamlit session state management
 def get_db_manager():
@@ -201,5 +670,5 @@ def close_db_manager():
         st.session_state.db_manager = None
 
 if __name__ == "__main__":
-    db_manager = DatabaseManager(config["chat_sessions_database_path"])
+    db_manager = DatabaseManager(config["chat_sessions_database_path"], config.get("sqlite"))
     db_manager.close()
\ No newline at end of file
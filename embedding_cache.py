@@ -0,0 +1,108 @@
+from langchain_core.embeddings import Embeddings
+from database_operations import DatabaseConnection
+from utils import CacheStats
+from typing import List, Dict, Optional
+import threading
+import hashlib
+import array
+import time
+
+# SQLite limits the number of bound parameters per statement
+MAX_QUERY_PARAMETERS = 900
+
+class EmbeddingCache(CacheStats):
+    """Disk-backed store of embedding vectors keyed by embedding model and text hash."""
+
+    def __init__(self, db_path: str, max_entries: int = 200000):
+        self.db = DatabaseConnection(db_path)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.create_table()
+
+    def create_table(self) -> None:
+        with self.db.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, text_hash)
+                );
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, text_hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        unique_hashes = list(dict.fromkeys(text_hashes))
+        with self._lock, self.db.cursor() as cursor:
+            for start in range(0, len(unique_hashes), MAX_QUERY_PARAMETERS):
+                hashes = unique_hashes[start:start + MAX_QUERY_PARAMETERS]
+                cursor.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(hashes))})",
+                    [model] + hashes
+                )
+                for text_hash, vector in cursor.fetchall():
+                    found[text_hash] = array.array("f", vector).tolist()
+            now = time.time()
+            cursor.executemany("UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                               [(now, model, text_hash) for text_hash in found])
+            self.hits += sum(1 for text_hash in text_hashes if text_hash in found)
+            self.misses += sum(1 for text_hash in text_hashes if text_hash not in found)
+        return found
+
+    def put_many(self, model: str, vectors: Dict[str, List[float]]) -> None:
+        now = time.time()
+        with self._lock, self.db.cursor() as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(model, text_hash, array.array("f", vector).tobytes(), now) for text_hash, vector in vectors.items()]
+            )
+            cursor.execute("SELECT COUNT(*) FROM embeddings")
+            overflow = cursor.fetchone()[0] - self.max_entries
+            if overflow > 0:
+                # Least recently used vectors are evicted first
+                cursor.execute(
+                    "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                    (overflow,)
+                )
+
+
+    def close(self) -> None:
+        self.db.close()
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an embeddings backend and only sends texts to it that are not in the cache yet.
+
+    Texts are hashed with the document or query prefix of the backend applied, so backends that
+    embed queries and documents differently never get a query vector for a document or the reverse.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model: Optional[str] = None):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model or getattr(embeddings, "model", type(embeddings).__name__)
+        self.document_prefix = getattr(embeddings, "document_prefix", "")
+        self.query_prefix = getattr(embeddings, "query_prefix", "")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        text_hashes = [self.cache.text_hash(self.document_prefix + text) for text in texts]
+        vectors = self.cache.get_many(self.model, text_hashes)
+        missing = {text_hash: text for text_hash, text in zip(text_hashes, texts) if text_hash not in vectors}
+        if missing:
+            new_vectors = dict(zip(missing.keys(), self.embeddings.embed_documents(list(missing.values()))))
+            self.cache.put_many(self.model, new_vectors)
+            vectors.update(new_vectors)
+        return [vectors[text_hash] for text_hash in text_hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        text_hash = self.cache.text_hash(self.query_prefix + text)
+        vectors = self.cache.get_many(self.model, [text_hash])
+        if text_hash not in vectors:
+            vectors[text_hash] = self.embeddings.embed_query(text)
+            self.cache.put_many(self.model, vectors)
+        return vectors[text_hash]
@@ -0,0 +1,72 @@
+"""Measures recall and latency of the retrieval modes on the questions in pdfs/eval_questions.json.
+
+The pdfs in pdfs/ are ingested into a temporary vector store and document registry that are
+deleted when the run ends, the collection of the app is not touched.
+The embedding model has to be available in ollama.
+Run from the repository root: python3 evaluate_retrieval.py [k]
+"""
+from database_operations import DatabaseManager, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP
+from pdf_handler import add_documents_to_db
+from vectordb_handler import vector_store_cache, vector_store_config, get_embeddings
+from retrieval import search_documents
+import statistics
+import tempfile
+import shutil
+import json
+import glob
+import time
+import sys
+import io
+import os
+
+EVAL_SET_PATH = os.path.join("pdfs", "eval_questions.json")
+SETUPS = [("vector", False), ("vector", True), ("hybrid", False), ("hybrid", True)]
+
+def ingest_eval_pdfs(vector_db, document_repo):
+    pdf_files = []
+    for path in sorted(glob.glob(os.path.join("pdfs", "*.pdf"))):
+        with open(path, "rb") as pdf:
+            pdf_file = io.BytesIO(pdf.read())
+        pdf_file.name = os.path.basename(path)
+        pdf_files.append(pdf_file)
+    add_documents_to_db(pdf_files, chunk_size=DEFAULT_CHUNK_SIZE, chunk_overlap=DEFAULT_CHUNK_OVERLAP,
+                        vector_db=vector_db, document_repo=document_repo)
+
+def is_relevant(document, question):
+    return document.metadata.get("source") == question["source"] and document.metadata.get("page") in question["pages"]
+
+def evaluate(vector_db, document_repo, questions, k):
+    query_vectors = [vector_db.embeddings.embed_query(question["question"]) for question in questions]
+
+    print(f"{len(questions)} questions, k = {k}")
+    print(f"{'mode':>8} {'mmr':>5} {'recall':>7} {'median ms':>10} {'max ms':>8}")
+    for mode, mmr in SETUPS:
+        hits = 0
+        timings = []
+        for question, query_vector in zip(questions, query_vectors):
+            start_time = time.perf_counter()
+            documents = search_documents(vector_db, question["question"], query_vector, k, mode=mode, mmr=mmr,
+                                         document_repo=document_repo)
+            timings.append((time.perf_counter() - start_time) * 1000)
+            hits += any(is_relevant(document, question) for document in documents)
+        print(f"{mode:>8} {str(mmr):>5} {hits / len(questions):>7.2f} {statistics.median(timings):>10.1f} {max(timings):>8.1f}")
+
+def main(k):
+    with open(EVAL_SET_PATH) as eval_file:
+        questions = json.load(eval_file)
+    tmp_dir = tempfile.mkdtemp(prefix="evaluate_retrieval_")
+    vector_db = vector_store_cache.get(os.path.join(tmp_dir, "vectordb"), "evaluation", get_embeddings(),
+                                       storage=vector_store_config.get("storage", "chroma"))
+    registry = DatabaseManager(os.path.join(tmp_dir, "documents.db"))
+    try:
+        ingest_eval_pdfs(vector_db, registry.document_repo)
+        evaluate(vector_db, registry.document_repo, questions, k)
+    finally:
+        if hasattr(vector_db, "close"):
+            vector_db.close()
+        vector_store_cache.invalidate(os.path.join(tmp_dir, "vectordb"))
+        registry.close()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
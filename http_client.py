@@ -0,0 +1,87 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+import requests
+import threading
+import bisect
+import time
+
+# Upper bounds of the latency histogram buckets in milliseconds, the last bucket catches everything slower
+LATENCY_BUCKETS_MS = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, float("inf")]
+
+class LatencyHistogram:
+    """Counts request latencies per endpoint in fixed buckets."""
+
+    def __init__(self, buckets_ms=LATENCY_BUCKETS_MS):
+        self.buckets_ms = buckets_ms
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, elapsed_ms):
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {"count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                                          "buckets": [0] * len(self.buckets_ms)})
+            stats["count"] += 1
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+            stats["buckets"][bisect.bisect_left(self.buckets_ms, elapsed_ms)] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                endpoint: {
+                    "count": stats["count"],
+                    "mean_ms": stats["total_ms"] / stats["count"],
+                    "max_ms": stats["max_ms"],
+                    "buckets": dict(zip([str(bound) for bound in self.buckets_ms], stats["buckets"]))
+                }
+                for endpoint, stats in self._endpoints.items()
+            }
+
+class HTTPClient:
+    """Shared keep-alive session for all model server calls with timeouts, retries and latency tracking."""
+
+    def __init__(self, connect_timeout=5, read_timeout=600, pool_maxsize=10, max_retries=3, backoff_factor=0.5):
+        self.timeout = (connect_timeout, read_timeout)
+        self.latencies = LatencyHistogram()
+        # Only failures where the server did not process the request are retried: connection errors
+        # and 429/503 responses. A read timeout on POST /api/chat would send the generation again.
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=False, # re-raise the ReadTimeout instead of wrapping it in a retry error
+            other=0,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[429, 503],
+            allowed_methods=None, # model servers are called with POST, retry those too
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        split_url = urlsplit(url)
+        endpoint = f"{method} {split_url.netloc}{split_url.path}"
+        start_time = time.perf_counter()
+        try:
+            # For streamed responses this measures the time until the headers arrived
+            return self.session.request(method, url, **kwargs)
+        finally:
+            self.latencies.record(endpoint, (time.perf_counter() - start_time) * 1000)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def latency_stats(self):
+        return self.latencies.snapshot()
+
+    def close(self):
+        self.session.close()
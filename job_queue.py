@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor
+from database_operations import db_manager, JobRepository
+from utils import load_config
+import traceback
+import threading
+import time
+
+config = load_config()
+
+class JobCancelled(Exception):
+    pass
+
+class JobContext:
+    """Handed to every job handler to report progress and to notice cancellation."""
+
+    # Progress is written to the database at most this often, polling the UI does not need more
+    PROGRESS_WRITE_INTERVAL = 0.5
+
+    def __init__(self, job_repo: JobRepository, job_id: int, cancel_event: threading.Event):
+        self.job_repo = job_repo
+        self.job_id = job_id
+        self.cancel_event = cancel_event
+        self.progress = 0.0
+        self._last_write = 0.0
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def report_progress(self, progress, message=None, partial_result=None):
+        """Stores the progress between 0 and 1, raises JobCancelled if the job was cancelled.
+
+        A partial result is stored as the job result while it runs and is always written right away.
+        """
+        if self.cancelled:
+            raise JobCancelled()
+        self.progress = min(max(progress, 0.0), 1.0)
+        now = time.monotonic()
+        if partial_result is not None or now - self._last_write >= self.PROGRESS_WRITE_INTERVAL:
+            self.job_repo.update_job(self.job_id, progress=self.progress, message=message, result=partial_result)
+            self._last_write = now
+
+class JobQueue:
+    """Runs long tasks on worker threads, one pool per job type caps its concurrency."""
+
+    def __init__(self, job_repo: JobRepository, max_concurrency=None, default_concurrency=1):
+        self.job_repo = job_repo
+        self.max_concurrency = max_concurrency or {}
+        self.default_concurrency = default_concurrency
+        self._handlers = {}
+        self._executors = {}
+        self._cancel_events = {}
+        self._lock = threading.Lock()
+        self.job_repo.fail_interrupted_jobs()
+
+    def register(self, job_type, handler):
+        """handler(context, *args, **kwargs) is called on a worker thread, its return value must be json serializable."""
+        with self._lock:
+            self._handlers[job_type] = handler
+            if job_type not in self._executors:
+                self._executors[job_type] = ThreadPoolExecutor(
+                    max_workers=self.max_concurrency.get(job_type, self.default_concurrency),
+                    thread_name_prefix=f"job_{job_type}"
+                )
+
+    def submit(self, job_type, *args, chat_history_id=None, **kwargs):
+        if job_type not in self._handlers:
+            raise ValueError(f"Unknown job type: {job_type}")
+        job_id = self.job_repo.create_job(job_type, chat_history_id)
+        cancel_event = threading.Event()
+        with self._lock:
+            self._cancel_events[job_id] = cancel_event
+        self._executors[job_type].submit(self._run, job_id, self._handlers[job_type], cancel_event, args, kwargs)
+        return job_id
+
+    def _run(self, job_id, handler, cancel_event, args, kwargs):
+        try:
+            if cancel_event.is_set():
+                raise JobCancelled()
+            self.job_repo.update_job(job_id, status="running")
+            context = JobContext(self.job_repo, job_id, cancel_event)
+            result = handler(context, *args, **kwargs)
+            self.job_repo.update_job(job_id, status="done", progress=1.0, result=result)
+        except JobCancelled:
+            self.job_repo.update_job(job_id, status="cancelled", message="Cancelled")
+        except Exception as e:
+            traceback.print_exc()
+            self.job_repo.update_job(job_id, status="failed", message=str(e))
+        finally:
+            with self._lock:
+                self._cancel_events.pop(job_id, None)
+
+    def cancel(self, job_id):
+        """Queued jobs are skipped, running jobs stop at their next progress report."""
+        with self._lock:
+            cancel_event = self._cancel_events.get(job_id)
+        if cancel_event:
+            cancel_event.set()
+
+    def get_job(self, job_id):
+        return self.job_repo.get_job(job_id)
+
+    def is_active(self, job):
+        return job is not None and job["status"] in JobRepository.ACTIVE_STATUSES
+
+job_config = config.get("jobs", {})
+job_queue = JobQueue(db_manager.job_repo, max_concurrency=job_config.get("max_concurrency", {}))
@@ -0,0 +1,160 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from http_client import LatencyHistogram
+import asyncio
+import threading
+import time
+
+class FairLimiter:
+    """Grants at most limit slots at a time, sessions waiting for a slot are served round robin.
+
+    Must only be used from the dispatcher's event loop.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        # session id -> waiting futures of that session, the first session is served next
+        self._waiters = OrderedDict()
+
+    @property
+    def queue_depth(self):
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    async def acquire(self, session_id):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(session_id, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just before the cancellation, hand it on
+                self.release()
+            else:
+                self._remove(session_id, waiter)
+            raise
+
+    def _remove(self, session_id, waiter):
+        waiters = self._waiters.get(session_id)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiters[session_id]
+
+    def release(self):
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < self.limit:
+            session_id, waiters = self._waiters.popitem(last=False)
+            waiter = waiters.popleft()
+            if waiters:
+                # The session goes to the back, others with waiting requests are served first
+                self._waiters[session_id] = waiters
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
+
+class LLMDispatcher:
+    """Sits between the chat handlers and the model servers, called from the blocking streamlit threads.
+
+    An asyncio loop on a background thread schedules the requests: at most max_in_flight requests
+    per model are sent at a time, the waiting ones are taken round robin across sessions, and
+    requests with the same coalesce key that are sent while an identical one is in flight share
+    its result. Blocking http calls run in a thread pool, streams are consumed by the calling thread
+    while they hold their slot.
+    """
+
+    def __init__(self, max_in_flight, worker_threads=16):
+        # function(model name) -> requests sent to the model at the same time
+        self.max_in_flight = max_in_flight
+        self.wait_times = LatencyHistogram()
+        self.coalesced_count = 0
+        self._limiters = {}
+        self._in_flight_calls = {}
+        self._executor = ThreadPoolExecutor(max_workers=worker_threads, thread_name_prefix="llm-dispatcher")
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-dispatcher-loop", daemon=True)
+        self._thread.start()
+
+    def _limiter(self, limit_key):
+        # Only called on the loop thread
+        if limit_key not in self._limiters:
+            self._limiters[limit_key] = FairLimiter(self.max_in_flight(limit_key[-1]))
+        return self._limiters[limit_key]
+
+    async def _acquire(self, limit_key, session_id):
+        enqueued = time.perf_counter()
+        await self._limiter(limit_key).acquire(session_id)
+        wait_ms = (time.perf_counter() - enqueued) * 1000
+        self.wait_times.record(" ".join(limit_key), wait_ms)
+        return wait_ms
+
+    async def _run(self, func, args, limit_key, session_id):
+        if limit_key is None:
+            return await self._loop.run_in_executor(self._executor, func, *args)
+        await self._acquire(limit_key, session_id)
+        try:
+            return await self._loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self._limiters[limit_key].release()
+
+    async def _call(self, func, args, limit_key, session_id, coalesce_key):
+        if coalesce_key is None:
+            return await self._run(func, args, limit_key, session_id)
+        task = self._in_flight_calls.get(coalesce_key)
+        if task is not None:
+            self.coalesced_count += 1
+        else:
+            task = self._loop.create_task(self._run(func, args, limit_key, session_id))
+            self._in_flight_calls[coalesce_key] = task
+            task.add_done_callback(lambda _: self._in_flight_calls.pop(coalesce_key, None))
+        # A caller that gives up does not cancel the request the others are waiting for
+        return await asyncio.shield(task)
+
+    def call(self, func, *args, limit_key=None, session_id=None, coalesce_key=None):
+        """Runs func(*args) once a slot of limit_key, an (endpoint, model) tuple, is free and returns its result.
+
+        Without a limit_key the call is not limited, only coalesced.
+        """
+        future = asyncio.run_coroutine_threadsafe(self._call(func, args, limit_key, session_id, coalesce_key), self._loop)
+        return future.result()
+
+    def stream(self, make_stream, limit_key, session_id=None):
+        """Yields from the generator make_stream() returns, the slot of limit_key is held until it is exhausted or closed."""
+        future = asyncio.run_coroutine_threadsafe(self._acquire(limit_key, session_id), self._loop)
+        try:
+            wait_ms = future.result()
+        except BaseException:
+            # The script thread was stopped while waiting, a slot granted meanwhile must not leak
+            if not future.cancel() and future.exception() is None:
+                self._loop.call_soon_threadsafe(self._limiters[limit_key].release)
+            raise
+        if wait_ms >= 1:
+            print(f"Waited {wait_ms:.0f} ms for a free {' '.join(limit_key)} slot")
+        try:
+            yield from make_stream()
+        finally:
+            self._loop.call_soon_threadsafe(self._limiters[limit_key].release)
+
+    def stats(self):
+        """Queue depth and in flight requests per (endpoint, model) with the wait time histograms."""
+        async def collect():
+            return {" ".join(limit_key): {"limit": limiter.limit, "in_flight": limiter.in_flight,
+                                          "queue_depth": limiter.queue_depth}
+                    for limit_key, limiter in self._limiters.items()}
+        return {
+            "models": asyncio.run_coroutine_threadsafe(collect(), self._loop).result(),
+            "wait_ms": self.wait_times.snapshot(),
+            "coalesced": self.coalesced_count,
+        }
+
+    def queue_depth(self):
+        return sum(model_stats["queue_depth"] for model_stats in self.stats()["models"].values())
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,87 @@
+from langchain_core.embeddings import Embeddings
+from typing import List, Optional
+import threading
+
+try:
+    import torch
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    torch = None
+    SentenceTransformer = None
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """Embeds in-process on the cpu with sentence-transformers, optionally through ONNX Runtime.
+
+    Texts are sorted by token count and grouped into batches of at most max_batch_tokens padded
+    tokens, so short chunks are sent in large batches and are not padded to the longest chunk.
+    With max_batch_tokens 0 the texts are sent in fixed batches of max_batch_size.
+    The model is loaded on the first call.
+    """
+
+    def __init__(self, model: str, device: str = "cpu", num_threads: Optional[int] = None,
+                 max_batch_tokens: int = 8192, max_batch_size: int = 128, onnx: bool = False,
+                 document_prefix: str = "", query_prefix: str = "", trust_remote_code: bool = False):
+        if SentenceTransformer is None:
+            raise ImportError("The sentence_transformers embedding backend needs: pip install sentence-transformers")
+        self.model = model
+        self.device = device
+        self.num_threads = num_threads
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.onnx = onnx
+        self.document_prefix = document_prefix
+        self.query_prefix = query_prefix
+        self.trust_remote_code = trust_remote_code
+        self._client = None
+        # One batch at a time, torch already spreads a batch over num_threads
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._client is None:
+            if self.num_threads:
+                # Process wide, whisper running in the same process uses the same thread count
+                torch.set_num_threads(self.num_threads)
+            options = {"backend": "onnx"} if self.onnx else {}
+            self._client = SentenceTransformer(self.model, device=self.device,
+                                               trust_remote_code=self.trust_remote_code, **options)
+        return self._client
+
+    def _batches(self, texts: List[str]):
+        """Yields lists of text indexes, shortest texts first."""
+        if not self.max_batch_tokens:
+            for start in range(0, len(texts), self.max_batch_size):
+                yield list(range(start, min(start + self.max_batch_size, len(texts))))
+            return
+        token_counts = [len(input_ids) for input_ids in self._client.tokenizer(
+            texts, truncation=True, max_length=self._client.max_seq_length)["input_ids"]]
+        batch = []
+        longest = 0
+        for index in sorted(range(len(texts)), key=token_counts.__getitem__):
+            longest_with_text = max(longest, token_counts[index])
+            if batch and (longest_with_text * (len(batch) + 1) > self.max_batch_tokens or len(batch) >= self.max_batch_size):
+                yield batch
+                batch = []
+                longest_with_text = token_counts[index]
+            batch.append(index)
+            longest = longest_with_text
+        if batch:
+            yield batch
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        vectors = [None] * len(texts)
+        with self._lock:
+            client = self._load()
+            for batch in self._batches(texts):
+                batch_vectors = client.encode([texts[index] for index in batch], batch_size=len(batch),
+                                              convert_to_numpy=True, normalize_embeddings=True)
+                for index, vector in zip(batch, batch_vectors):
+                    vectors[index] = vector.tolist()
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed([self.document_prefix + text for text in texts])
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([self.query_prefix + text])[0]
@@ -0,0 +1,143 @@
+from utils import load_config, http_client, llm_dispatcher, get_json
+from context_builder import ContextBuilder
+import threading
+import json
+import time
+import os
+
+config = load_config()
+catalog_config = config.get("model_catalog", {})
+
+def ollama_model_metadata(model, size=None):
+    """Context length and multimodal capability from /api/show, sent once per model digest."""
+    url = config["ollama"]["base_url"] + "/api/show"
+    show = llm_dispatcher.call(lambda: http_client.post(url=url, json={"model": model}).json(), coalesce_key=("POST", url, model))
+    model_info = show.get("model_info", {})
+    architecture = model_info.get("general.architecture")
+    if "capabilities" in show:
+        multimodal = "vision" in show["capabilities"]
+    else:
+        # Ollama versions before capabilities were reported list the vision encoder as a projector
+        families = show.get("details", {}).get("families") or []
+        multimodal = "projector_info" in show or any(family in ("clip", "mllama") for family in families)
+    return {"context_length": model_info.get(f"{architecture}.context_length"), "multimodal": multimodal, "size": size}
+
+def fetch_ollama_models(known_models):
+    url = config["ollama"]["base_url"] + "/api/tags"
+    json_response = llm_dispatcher.call(get_json, url, coalesce_key=("GET", url))
+    if json_response.get("error", False):
+        raise RuntimeError("OLLAMA ERROR: " + json_response["error"])
+    models = {}
+    for model in json_response["models"]:
+        if "embed" in model["name"]:
+            continue
+        known = known_models.get(model["name"])
+        if known and known.get("digest") == model.get("digest"):
+            models[model["name"]] = known
+            continue
+        models[model["name"]] = dict(ollama_model_metadata(model["name"], model.get("size")), digest=model.get("digest"))
+    return models
+
+def fetch_openai_models(known_models):
+    url = "https://api.openai.com/v1/models"
+    response = llm_dispatcher.call(get_json, url, {"Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}"},
+                                   coalesce_key=("GET", url))
+    if response.get("error", False):
+        raise RuntimeError("OPENAI ERROR: " + response["error"]["message"])
+    multimodal_prefixes = tuple(catalog_config.get("openai_multimodal_prefixes", []))
+    budget_config = config.get("context_budget", {})
+    # The listing has no metadata, context windows come from context_budget
+    return {item["id"]: {"context_length": ContextBuilder._lookup_context_window(item["id"], budget_config),
+                         "multimodal": item["id"].startswith(multimodal_prefixes), "size": None}
+            for item in response["data"]}
+
+def supports_multiple_images(model):
+    """False for vision models that answer only one image per request, like llama3.2-vision on ollama."""
+    return not model.startswith(tuple(catalog_config.get("single_image_prefixes", [])))
+
+def pull_ollama_model_job(context, model_name):
+    """Background job that streams the pull progress of ollama into the job context."""
+    with http_client.post(url = config["ollama"]["base_url"] + "/api/pull",
+                          json = {"model": model_name, "stream": True},
+                          stream = True,
+                          timeout = (http_client.timeout[0], 1800)) as response:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            json_chunk = json.loads(line)
+            if "error" in json_chunk.keys():
+                raise RuntimeError(json_chunk["error"])
+            total = json_chunk.get("total")
+            completed = json_chunk.get("completed")
+            context.report_progress(completed / total if total and completed else context.progress, json_chunk.get("status"))
+    # The listing is refreshed before the job is done, the sidebar shows the model right away
+    model_catalog.refresh("ollama")
+    return f"Pull of {model_name} finished."
+
+class ModelCatalog:
+    """Model listings per endpoint kept in memory, so the sidebar never waits on a model server.
+
+    A listing older than ttl_seconds is still served while a background thread refreshes it.
+    Failed refreshes keep the last listing and record the error.
+    """
+
+    def __init__(self, fetchers, ttl_seconds=300):
+        # endpoint -> function(known models) returning {model name: metadata}
+        self.fetchers = fetchers
+        self.ttl_seconds = ttl_seconds
+        self._listings = {endpoint: {"models": {}, "fetched_at": None, "error": None, "refreshing": False,
+                                     "ready": threading.Event()}
+                          for endpoint in fetchers}
+        self._lock = threading.Lock()
+
+    def refresh(self, endpoint):
+        """Fetches the listing of endpoint in the calling thread."""
+        listing = self._listings[endpoint]
+        with self._lock:
+            known_models = dict(listing["models"])
+        try:
+            models = self.fetchers[endpoint](known_models)
+            with self._lock:
+                listing.update(models=models, fetched_at=time.time(), error=None)
+        except Exception as e:
+            print(f"Listing {endpoint} models failed: {e}")
+            with self._lock:
+                listing.update(fetched_at=time.time(), error=str(e))
+        finally:
+            with self._lock:
+                listing["refreshing"] = False
+            listing["ready"].set()
+
+    def refresh_in_background(self, endpoint):
+        with self._lock:
+            if self._listings[endpoint]["refreshing"]:
+                return
+            self._listings[endpoint]["refreshing"] = True
+        threading.Thread(target=self.refresh, args=(endpoint,), name=f"model-catalog-{endpoint}", daemon=True).start()
+
+    def get_models(self, endpoint, wait_seconds=0):
+        """{model name: metadata} from memory, waits at most wait_seconds if the endpoint was never listed."""
+        listing = self._listings[endpoint]
+        with self._lock:
+            stale = listing["fetched_at"] is None or time.time() - listing["fetched_at"] > self.ttl_seconds
+        if stale:
+            self.refresh_in_background(endpoint)
+        listing["ready"].wait(wait_seconds)
+        with self._lock:
+            return dict(listing["models"])
+
+    def get_model_names(self, endpoint, wait_seconds=0):
+        return list(self.get_models(endpoint, wait_seconds).keys())
+
+    def get_metadata(self, endpoint, model):
+        with self._lock:
+            return self._listings[endpoint]["models"].get(model)
+
+    def get_error(self, endpoint):
+        with self._lock:
+            return self._listings[endpoint]["error"]
+
+model_catalog = ModelCatalog({"ollama": fetch_ollama_models, "openai": fetch_openai_models},
+                             ttl_seconds=catalog_config.get("ttl_seconds", 300))
+# The default endpoint is listed while the first page loads
+model_catalog.refresh_in_background("ollama")
@@ -0,0 +1,74 @@
+from utils import load_config, http_client, llm_dispatcher, get_keep_alive, convert_ns_to_seconds
+import threading
+import time
+
+config = load_config()
+ollama_config = config["ollama"]
+
+class LoadTimeStats:
+    """Per model load, prompt eval and eval time of the ollama turns, to see what cold starts cost."""
+
+    def __init__(self, cold_start_seconds=0.5):
+        self.cold_start_seconds = cold_start_seconds
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _model_stats(self, model):
+        return self._models.setdefault(model, {"turns": 0, "cold_starts": 0, "load_seconds": 0.0, "prompt_eval_seconds": 0.0,
+                                               "eval_seconds": 0.0, "total_seconds": 0.0, "warmups": 0, "warmup_seconds": 0.0})
+
+    def record_turn(self, json_response):
+        """Records the durations of the final chunk of a chat response, returns True for a cold start."""
+        load_seconds = convert_ns_to_seconds(json_response.get("load_duration", 0))
+        cold_start = load_seconds >= self.cold_start_seconds
+        with self._lock:
+            stats = self._model_stats(json_response.get("model", ""))
+            stats["turns"] += 1
+            stats["cold_starts"] += cold_start
+            stats["load_seconds"] += load_seconds
+            stats["prompt_eval_seconds"] += convert_ns_to_seconds(json_response.get("prompt_eval_duration", 0))
+            stats["eval_seconds"] += convert_ns_to_seconds(json_response.get("eval_duration", 0))
+            stats["total_seconds"] += convert_ns_to_seconds(json_response.get("total_duration", 0))
+        return cold_start
+
+    def record_warmup(self, model, seconds):
+        with self._lock:
+            stats = self._model_stats(model)
+            stats["warmups"] += 1
+            stats["warmup_seconds"] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {model: dict(stats) for model, stats in self._models.items()}
+
+class WarmupManager:
+    """Loads ollama models ahead of their first request, so the user does not wait for the weights to load."""
+
+    def __init__(self, base_url, load_times):
+        self.base_url = base_url
+        self.load_times = load_times
+
+    def warm_chat_model(self, model):
+        """Sends an empty prompt, ollama then only loads the model and keeps it for its keep_alive."""
+        url = self.base_url + "/api/generate"
+        start_time = time.perf_counter()
+        json_response = llm_dispatcher.call(
+            lambda: http_client.post(url=url, json={"model": model, "keep_alive": get_keep_alive(model)}).json(),
+            coalesce_key=("POST", url, model))
+        if "error" in json_response.keys():
+            print(f"Warmup of {model} failed: {json_response['error']}")
+            return
+        elapsed = time.perf_counter() - start_time
+        self.load_times.record_warmup(model, elapsed)
+        print(f"Warmed up {model} in {elapsed:.2f} seconds")
+
+    def in_background(self, func, *args):
+        def run():
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Warmup failed: {e}")
+        threading.Thread(target=run, name="model-warmup", daemon=True).start()
+
+load_times = LoadTimeStats(cold_start_seconds=ollama_config.get("cold_start_seconds", 0.5))
+warmup_manager = WarmupManager(ollama_config["base_url"], load_times)
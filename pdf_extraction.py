@@ -0,0 +1,15 @@
+"""Page extraction run in the worker processes of pdf_handler.
+
+Workers are started with spawn and import this module, it must stay free of
+imports with side effects like loading the config or opening databases.
+"""
+import pypdfium2
+
+def extract_page_range(pdf_source, start_page, end_page):
+    """Every worker opens its own pypdfium2 document from a file path or bytes."""
+    pdf_file = pypdfium2.PdfDocument(pdf_source)
+    try:
+        return [(page_number, pdf_file.get_page(page_number).get_textpage().get_text_range())
+                for page_number in range(start_page, end_page)]
+    finally:
+        pdf_file.close()
@@ -1,36 +1,211 @@
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema.document import Document
-from vectordb_handler import load_vectordb
+from vectordb_handler import load_vectordb, mark_collection_changed
+from database_operations import db_manager, DocumentRepository
 from utils import load_config, timeit
+from pdf_extraction import extract_page_range
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque, Counter
+import multiprocessing
 import pypdfium2
+import tempfile
+import hashlib
+import threading
+import os
 import streamlit as st
 
 config = load_config()
+ingestion_config = config.get("pdf_ingestion", {})
 
-def get_pdf_texts(pdfs_bytes_list):
-    return [extract_text_from_pdf(pdf_bytes.getvalue()) for pdf_bytes in pdfs_bytes_list]
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
 
-def extract_text_from_pdf(pdf_bytes):
+def get_extraction_pool():
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            # Forking would copy the threads and open connections of the app into the workers
+            _extraction_pool = ProcessPoolExecutor(max_workers=ingestion_config.get("extraction_workers", 4),
+                                                   mp_context=multiprocessing.get_context(ingestion_config.get("start_method", "spawn")))
+        return _extraction_pool
+
+def count_pdf_pages(pdf_bytes):
     pdf_file = pypdfium2.PdfDocument(pdf_bytes)
-    return "\n".join(pdf_file.get_page(page_number).get_textpage().get_text_range() for page_number in range(len(pdf_file)))
-    
-def get_text_chunks(text):
-    splitter = RecursiveCharacterTextSplitter(chunk_size=st.session_state.chunk_size, 
-                                              chunk_overlap=st.session_state.chunk_overlap,
-                                              separators=["\n", "\n\n"])
-    return splitter.split_text(text)
-
-def get_document_chunks(text_list):
-    documents = []
-    for text in text_list:
-        for chunk in get_text_chunks(text):
-            documents.append(Document(page_content = chunk))
-    return documents
+    try:
+        return len(pdf_file)
+    finally:
+        pdf_file.close()
+
+def iter_page_texts(pdf_sources):
+    """Yields (source, page_number, text) in page order while the pages are extracted in parallel.
+
+    pdf_sources is a list of (name, pdf_bytes, page_count). Only a bounded number of page
+    ranges is in flight at once, so memory does not grow with the size of the upload.
+    Every pdf is written to a temporary file once, the tasks only send its path to the workers
+    instead of pickling the whole pdf for every page range.
+    """
+    pool = get_extraction_pool()
+    pages_per_task = ingestion_config.get("pages_per_task", 8)
+    max_pending = 2 * ingestion_config.get("extraction_workers", 4)
+    pending = deque()
+    tmp_paths = []
+    try:
+        for name, pdf_bytes, page_count in pdf_sources:
+            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp_file:
+                tmp_file.write(pdf_bytes)
+            tmp_paths.append(tmp_file.name)
+            for start_page in range(0, page_count, pages_per_task):
+                end_page = min(start_page + pages_per_task, page_count)
+                pending.append((name, pool.submit(extract_page_range, tmp_file.name, start_page, end_page)))
+                if len(pending) >= max_pending:
+                    done_name, future = pending.popleft()
+                    for page_number, text in future.result():
+                        yield done_name, page_number, text
+        while pending:
+            done_name, future = pending.popleft()
+            for page_number, text in future.result():
+                yield done_name, page_number, text
+    finally:
+        # Tasks still queued when the consumer stops early must not find their file gone
+        for _, future in pending:
+            future.cancel()
+        for _, future in pending:
+            if not future.cancelled():
+                future.exception()
+        for tmp_path in tmp_paths:
+            os.remove(tmp_path)
+
+def get_text_splitter(chunk_size=None, chunk_overlap=None):
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size or st.session_state.chunk_size,
+                                          chunk_overlap=chunk_overlap if chunk_overlap is not None else st.session_state.chunk_overlap,
+                                          separators=["\n", "\n\n"])
+
+def get_content_hash(pdf_bytes):
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+def get_chunk_id(document_name, page_number, chunk, occurrence, chat_history_id=DocumentRepository.SHARED_SCOPE):
+    """Stable id of a chunk, occurrence separates identical chunks on the same page."""
+    key = f"{document_name}\x00{page_number}\x00{occurrence}\x00{chunk}"
+    if chat_history_id != DocumentRepository.SHARED_SCOPE:
+        # Shared chunks keep the ids they had before documents were scoped to sessions
+        key = f"{chat_history_id}\x00{key}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
 
 @timeit
-def add_documents_to_db(pdfs_bytes):
-    texts = get_pdf_texts(pdfs_bytes)
-    documents = get_document_chunks(texts)
-    vector_db = load_vectordb()
-    vector_db.add_documents(documents)
-    print("Documents added to db.")
\ No newline at end of file
+def add_documents_to_db(pdfs_bytes, progress_callback=None, chunk_size=None, chunk_overlap=None,
+                        chat_history_id=DocumentRepository.SHARED_SCOPE, vector_db=None, document_repo=None):
+    """Extracts, chunks and embeds the uploaded pdfs as a stream and returns the names of skipped pdfs.
+
+    Page extraction runs in a process pool, embedding batches are written by a background
+    thread so they overlap with the extraction of the following pages.
+    Pdfs whose content is already indexed are skipped. For a revised pdf with a known name
+    only the changed chunks are embedded and the chunks that disappeared are deleted.
+    progress_callback(pages_done, total_pages, chunks_added) is called after every page.
+    chunk_size and chunk_overlap default to the session settings, they must be given outside the script thread.
+    The pdfs are only retrieved in the chat session chat_history_id, in every session if it is the shared scope.
+    vector_db and document_repo default to the configured vector store and the document registry of the app.
+    """
+    document_repo = document_repo or db_manager.document_repo
+    pdf_sources = []
+    documents = {}
+    skipped_documents = []
+    for pdf_file in pdfs_bytes:
+        pdf_bytes = pdf_file.getvalue()
+        document_name = getattr(pdf_file, "name", "pdf")
+        content_hash = get_content_hash(pdf_bytes)
+        if document_name in documents or document_repo.is_indexed(content_hash, chat_history_id):
+            print(f"Skipping {document_name}, already indexed.")
+            skipped_documents.append(document_name)
+            continue
+        page_count = count_pdf_pages(pdf_bytes)
+        pdf_sources.append((document_name, pdf_bytes, page_count))
+        documents[document_name] = {
+            "content_hash": content_hash,
+            "page_count": page_count,
+            "existing_chunk_ids": set(document_repo.get_chunk_ids(document_name, chat_history_id)),
+            "chunk_ids": set()
+        }
+    total_pages = sum(page_count for _, _, page_count in pdf_sources)
+
+    vector_db = vector_db or load_vectordb()
+    splitter = get_text_splitter(chunk_size, chunk_overlap)
+    batch_size = ingestion_config.get("embedding_batch_size", 64)
+    pages_done = 0
+    chunks_added = 0
+    batch = []
+    batch_ids = []
+    pending_batches = deque()
+
+    def add_batch(batch_documents, ids):
+        vector_db.add_documents(batch_documents, ids=ids)
+        # The texts go to the keyword index with their batch, the document keeps only the chunk ids
+        document_repo.register_chunks([{"chunk_id": chunk_id, "document_name": document.metadata["source"],
+                                        "page_number": document.metadata["page"], "chat_history_id": chat_history_id,
+                                        "content": document.page_content}
+                                       for chunk_id, document in zip(ids, batch_documents)])
+
+    with ThreadPoolExecutor(max_workers=1) as embedding_executor:
+        def submit_batch(batch_documents, ids):
+            pending_batches.append(embedding_executor.submit(add_batch, batch_documents, ids))
+            # At most two batches wait for embedding, extraction pauses if embedding is the bottleneck
+            while len(pending_batches) > 2:
+                pending_batches.popleft().result()
+
+        for source, page_number, text in iter_page_texts(pdf_sources):
+            document = documents[source]
+            page_occurrences = Counter()
+            for chunk in splitter.split_text(text):
+                chunk_id = get_chunk_id(source, page_number, chunk, page_occurrences[chunk], chat_history_id)
+                page_occurrences[chunk] += 1
+                document["chunk_ids"].add(chunk_id)
+                if chunk_id in document["existing_chunk_ids"]:
+                    continue
+                batch.append(Document(page_content=chunk, metadata={"source": source, "page": page_number, "chunk_id": chunk_id,
+                                                                           "chat_history_id": chat_history_id}))
+                batch_ids.append(chunk_id)
+                if len(batch) >= batch_size:
+                    submit_batch(batch, batch_ids)
+                    chunks_added += len(batch)
+                    batch, batch_ids = [], []
+            pages_done += 1
+            if progress_callback:
+                progress_callback(pages_done, total_pages, chunks_added)
+        if batch:
+            submit_batch(batch, batch_ids)
+            chunks_added += len(batch)
+        while pending_batches:
+            pending_batches.popleft().result()
+
+    chunks_deleted = False
+    for document_name, document in documents.items():
+        stale_chunk_ids = list(document["existing_chunk_ids"] - document["chunk_ids"])
+        if stale_chunk_ids:
+            vector_db.delete(ids=stale_chunk_ids)
+            chunks_deleted = True
+        document_repo.save_document(document_name, document["content_hash"], document["page_count"], stale_chunk_ids, chat_history_id)
+    if chunks_added or chunks_deleted:
+        mark_collection_changed()
+
+    if progress_callback:
+        progress_callback(pages_done, total_pages, chunks_added)
+    print(f"{chunks_added} chunks from {total_pages} pages added to db.")
+    return skipped_documents
+
+def delete_document_from_db(document_name, chat_history_id=DocumentRepository.SHARED_SCOPE):
+    """Removes all chunks of a document from the vector store and the document registry."""
+    chunk_ids = db_manager.document_repo.get_chunk_ids(document_name, chat_history_id)
+    if chunk_ids:
+        load_vectordb().delete(ids=chunk_ids)
+        mark_collection_changed()
+    db_manager.document_repo.delete_document(document_name, chat_history_id)
+
+def delete_session_documents(chat_history_id):
+    """Removes the pdfs uploaded in a chat session together with their vectors."""
+    for document_name in db_manager.document_repo.get_document_names(chat_history_id):
+        delete_document_from_db(document_name, chat_history_id)
+
+def ingest_pdfs_job(context, pdf_files, chunk_size, chunk_overlap, chat_history_id=DocumentRepository.SHARED_SCOPE):
+    """Background job wrapper around add_documents_to_db, returns the names of skipped pdfs."""
+    def report_progress(pages_done, total_pages, chunks_added):
+        context.report_progress(pages_done / max(total_pages, 1), f"{pages_done}/{total_pages} pages, {chunks_added} chunks embedded")
+    return add_documents_to_db(pdf_files, report_progress, chunk_size, chunk_overlap, chat_history_id)
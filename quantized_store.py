@@ -0,0 +1,271 @@
+from langchain_core.vectorstores import VectorStore
+from langchain_core.embeddings import Embeddings
+from langchain.schema.document import Document
+from database_operations import DatabaseConnection
+from typing import List, Dict, Any, Optional, Iterable
+import numpy as np
+import threading
+import json
+import os
+
+class QuantizedVectorStore(VectorStore):
+    """Compact vector store for large corpora, a drop-in for the chroma store behind load_vectordb.
+
+    Vectors are normalized and kept twice in memory-mapped .npy files: as int8 with one scale
+    per vector, scanned for every query, and as float32, only read for the best candidates
+    which are re-ranked by their exact cosine similarity. Texts and metadata live in sqlite.
+    Only the pages of the int8 file and of the re-ranked rows are paged in during a search.
+    """
+
+    INITIAL_CAPACITY = 1024
+    # Rows scanned at once, bounds the temporary float32 copy of the int8 block
+    SCAN_BLOCK_ROWS = 4096
+
+    def __init__(self, path: str, collection_name: str, embeddings: Embeddings, rerank_candidates: int = 50):
+        self.directory = os.path.join(path, collection_name)
+        os.makedirs(self.directory, exist_ok=True)
+        self._embeddings = embeddings
+        self.rerank_candidates = rerank_candidates
+        self.db = DatabaseConnection(os.path.join(self.directory, "index.db"))
+        self._lock = threading.RLock()
+        self.create_table()
+        self.dimension = None
+        self.capacity = 0
+        self.quantized = None
+        self.scales = None
+        self.vectors = None
+        # Live rows per filter, dropped on every write
+        self._live_rows_cache = {}
+        self._open_arrays()
+
+    def create_table(self) -> None:
+        with self.db.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS rows (
+                    row INTEGER PRIMARY KEY,
+                    chunk_id TEXT UNIQUE,
+                    content TEXT,
+                    metadata TEXT
+                );
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS store_info (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+            """)
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embeddings
+
+    def _array_path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}.npy")
+
+    def _open_arrays(self) -> None:
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT key, value FROM store_info")
+            info = dict(cursor.fetchall())
+        if "dimension" not in info:
+            return
+        self.dimension = info["dimension"]
+        self.capacity = info["capacity"]
+        self.quantized = np.load(self._array_path("quantized"), mmap_mode="r+")
+        self.scales = np.load(self._array_path("scales"), mmap_mode="r+")
+        self.vectors = np.load(self._array_path("vectors"), mmap_mode="r+")
+
+    def _resize(self, capacity: int) -> None:
+        """Grows the memory-mapped arrays, existing rows are copied into the new files."""
+        arrays = {
+            "quantized": (np.int8, (capacity, self.dimension), self.quantized),
+            "scales": (np.float32, (capacity,), self.scales),
+            "vectors": (np.float32, (capacity, self.dimension), self.vectors),
+        }
+        for name, (dtype, shape, old_array) in arrays.items():
+            tmp_path = self._array_path(name) + ".tmp"
+            new_array = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=shape)
+            if old_array is not None:
+                new_array[:len(old_array)] = old_array
+            new_array.flush()
+            del new_array
+            os.replace(tmp_path, self._array_path(name))
+        self.capacity = capacity
+        with self.db.cursor() as cursor:
+            cursor.executemany("INSERT OR REPLACE INTO store_info (key, value) VALUES (?, ?)",
+                               [("dimension", self.dimension), ("capacity", capacity)])
+        self._open_arrays()
+
+    @staticmethod
+    def quantize(vectors: np.ndarray):
+        """Symmetric int8 quantization with one scale per normalized vector."""
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+    def add_vectors(self, ids: List[str], vectors: List[List[float]], texts: List[str],
+                    metadatas: Optional[List[Dict[str, Any]]] = None) -> List[str]:
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = self._normalize(np.asarray(vectors, dtype=np.float32))
+        quantized, scales = self.quantize(vectors)
+        with self._lock:
+            if self.dimension is None:
+                self.dimension = vectors.shape[1]
+                self._resize(self.INITIAL_CAPACITY)
+            with self.db.cursor() as cursor:
+                rows = []
+                for chunk_id in ids:
+                    cursor.execute("SELECT row FROM rows WHERE chunk_id = ?", (chunk_id,))
+                    existing = cursor.fetchone()
+                    if existing:
+                        rows.append(existing[0])
+                        continue
+                    # Rows freed by deletes are reused before the arrays grow
+                    cursor.execute("SELECT row FROM rows WHERE chunk_id IS NULL LIMIT 1")
+                    free = cursor.fetchone()
+                    if free:
+                        row = free[0]
+                    else:
+                        cursor.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM rows")
+                        row = cursor.fetchone()[0]
+                    cursor.execute("INSERT OR REPLACE INTO rows (row, chunk_id) VALUES (?, ?)", (row, chunk_id))
+                    rows.append(row)
+                cursor.executemany(
+                    "UPDATE rows SET content = ?, metadata = ? WHERE row = ?",
+                    [(text, json.dumps(metadata), row) for text, metadata, row in zip(texts, metadatas, rows)]
+                )
+            required = max(rows) + 1
+            if required > self.capacity:
+                capacity = self.capacity
+                while capacity < required:
+                    capacity *= 2
+                self._resize(capacity)
+            self._live_rows_cache.clear()
+            self.quantized[rows] = quantized
+            self.scales[rows] = scales
+            self.vectors[rows] = vectors
+            self.quantized.flush()
+            self.scales.flush()
+            self.vectors.flush()
+        return ids
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if ids is None:
+            raise ValueError("QuantizedVectorStore needs ids for the added texts")
+        return self.add_vectors(ids, self._embeddings.embed_documents(texts), texts, metadatas)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> None:
+        if not ids:
+            return
+        with self._lock, self.db.cursor() as cursor:
+            self._live_rows_cache.clear()
+            cursor.executemany("UPDATE rows SET chunk_id = NULL, content = NULL, metadata = NULL WHERE chunk_id = ?",
+                               [(chunk_id,) for chunk_id in ids])
+
+    def _live_rows(self, filter: Optional[Dict[str, Any]] = None) -> np.ndarray:
+        """Rows holding a chunk, narrowed by a chroma style filter of {field: value} or {field: {"$in": [...]}}."""
+        cache_key = json.dumps(filter, sort_keys=True)
+        if cache_key in self._live_rows_cache:
+            return self._live_rows_cache[cache_key]
+        conditions = ["chunk_id IS NOT NULL"]
+        parameters = []
+        for field, condition in (filter or {}).items():
+            values = condition["$in"] if isinstance(condition, dict) else [condition]
+            conditions.append(f"json_extract(metadata, ?) IN ({','.join('?' * len(values))})")
+            parameters += [f"$.{field}"] + list(values)
+        with self.db.cursor() as cursor:
+            cursor.execute(f"SELECT row FROM rows WHERE {' AND '.join(conditions)} ORDER BY row", parameters)
+            live_rows = np.fromiter((row[0] for row in cursor.fetchall()), dtype=np.int64)
+        self._live_rows_cache[cache_key] = live_rows
+        return live_rows
+
+    def _load_documents(self, rows: List[int]) -> Dict[int, Document]:
+        with self.db.cursor() as cursor:
+            cursor.execute(f"SELECT row, content, metadata FROM rows WHERE row IN ({','.join('?' * len(rows))})",
+                           [int(row) for row in rows])
+            return {row: Document(page_content=content, metadata=json.loads(metadata))
+                    for row, content, metadata in cursor.fetchall()}
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               filter: Optional[Dict[str, Any]] = None):
+        """Returns (document, cosine similarity) pairs of the k most similar chunks."""
+        with self._lock:
+            if self.dimension is None:
+                return []
+            live_rows = self._live_rows(filter)
+            if len(live_rows) == 0:
+                return []
+            query = self._normalize(np.asarray(embedding, dtype=np.float32))
+            candidate_count = min(max(self.rerank_candidates, k), len(live_rows))
+            candidate_rows = np.empty(0, dtype=np.int64)
+            candidate_scores = np.empty(0, dtype=np.float32)
+            for start in range(0, len(live_rows), self.SCAN_BLOCK_ROWS):
+                block_rows = live_rows[start:start + self.SCAN_BLOCK_ROWS]
+                if block_rows[-1] - block_rows[0] + 1 == len(block_rows):
+                    # Consecutive rows are read through a slice, which avoids a gathered copy
+                    block = self.quantized[block_rows[0]:block_rows[-1] + 1]
+                else:
+                    block = self.quantized[block_rows]
+                scores = (block.astype(np.float32) @ query) * self.scales[block_rows]
+                candidate_rows = np.concatenate([candidate_rows, block_rows])
+                candidate_scores = np.concatenate([candidate_scores, scores])
+                if len(candidate_rows) > candidate_count:
+                    best = np.argpartition(-candidate_scores, candidate_count - 1)[:candidate_count]
+                    candidate_rows, candidate_scores = candidate_rows[best], candidate_scores[best]
+            # Exact re-ranking, only the float32 rows of the candidates are read from disk
+            candidate_rows = np.sort(candidate_rows)
+            exact_scores = self.vectors[candidate_rows] @ query
+            order = np.argsort(-exact_scores)[:k]
+            best_rows = [int(candidate_rows[index]) for index in order]
+            documents = self._load_documents(best_rows)
+        return [(documents[row], float(exact_scores[index])) for row, index in zip(best_rows, order)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4,
+                                    filter: Optional[Dict[str, Any]] = None, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score_by_vector(embedding, k, filter)]
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None,
+                          **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(self._embeddings.embed_query(query), k, filter)
+
+    def update_metadatas(self, ids: List[str], metadatas: List[Dict[str, Any]]) -> None:
+        """Replaces the metadata of existing chunks, their vectors are kept."""
+        with self._lock, self.db.cursor() as cursor:
+            self._live_rows_cache.clear()
+            cursor.executemany("UPDATE rows SET metadata = ? WHERE chunk_id = ?",
+                               [(json.dumps(metadata), chunk_id) for chunk_id, metadata in zip(ids, metadatas)])
+
+    def get(self, ids: Optional[List[str]] = None, include: Optional[List[str]] = None, **kwargs: Any) -> Dict[str, list]:
+        """Same shape as the chroma get result for the documents and metadatas of the given ids, all chunks without ids."""
+        include = ["documents", "metadatas"] if include is None else include
+        result = {"ids": []}
+        for field in include:
+            result[field] = []
+        if ids is not None and not ids:
+            return result
+        with self.db.cursor() as cursor:
+            if ids is None:
+                cursor.execute("SELECT chunk_id, content, metadata FROM rows WHERE chunk_id IS NOT NULL ORDER BY row")
+            else:
+                cursor.execute(f"SELECT chunk_id, content, metadata FROM rows WHERE chunk_id IN ({','.join('?' * len(ids))})", ids)
+            for chunk_id, content, metadata in cursor.fetchall():
+                result["ids"].append(chunk_id)
+                if "documents" in result:
+                    result["documents"].append(content)
+                if "metadatas" in result:
+                    result["metadatas"].append(json.loads(metadata))
+        return result
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, **kwargs: Any):
+        store = cls(kwargs["path"], kwargs["collection_name"], embedding)
+        store.add_texts(texts, metadatas, ids=kwargs["ids"])
+        return store
+
+    def close(self) -> None:
+        self.db.close()
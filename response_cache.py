@@ -0,0 +1,74 @@
+from database_operations import DatabaseConnection
+from utils import CacheStats
+from typing import List, Dict, Optional
+import threading
+import hashlib
+import json
+import time
+
+class ResponseCache(CacheStats):
+    """Disk-backed store of model answers keyed by a hash of the request that produced them."""
+
+    def __init__(self, db_path: str, ttl_seconds: float = 86400, max_entries: int = 10000):
+        self.db = DatabaseConnection(db_path)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.create_table()
+
+    def create_table(self) -> None:
+        with self.db.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    request_hash TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                );
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_responses_created_at ON responses (created_at)")
+
+    @staticmethod
+    def request_hash(endpoint: str, model: str, messages: List[Dict], options: Optional[Dict] = None) -> str:
+        # Sorted keys and fixed separators make equal requests serialize to the same string
+        canonical_request = json.dumps({"endpoint": endpoint, "model": model, "messages": messages, "options": options or {}},
+                                       sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()
+
+    def get(self, request_hash: str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self.db.cursor() as cursor:
+            cursor.execute("SELECT response FROM responses WHERE request_hash = ? AND created_at > ?",
+                           (request_hash, now - self.ttl_seconds))
+            row = cursor.fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            cursor.execute("UPDATE responses SET last_used = ? WHERE request_hash = ?", (now, request_hash))
+            self.hits += 1
+        return row[0]
+
+    def put(self, request_hash: str, response: str) -> None:
+        now = time.time()
+        with self._lock, self.db.cursor() as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO responses (request_hash, response, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (request_hash, response, now, now)
+            )
+            cursor.execute("DELETE FROM responses WHERE created_at <= ?", (now - self.ttl_seconds,))
+            cursor.execute("SELECT COUNT(*) FROM responses")
+            overflow = cursor.fetchone()[0] - self.max_entries
+            if overflow > 0:
+                # Least recently used answers are evicted first
+                cursor.execute(
+                    "DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses ORDER BY last_used ASC LIMIT ?)",
+                    (overflow,)
+                )
+
+    def clear(self) -> None:
+        with self._lock, self.db.cursor() as cursor:
+            cursor.execute("DELETE FROM responses")
+
+    def close(self) -> None:
+        self.db.close()
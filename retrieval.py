@@ -0,0 +1,192 @@
+from langchain.schema.document import Document
+from vectordb_handler import load_vectordb, semantic_cache, get_collection_version, mark_collection_changed
+from quantized_store import QuantizedVectorStore
+from database_operations import db_manager, DocumentRepository
+from http_client import LatencyHistogram
+from utils import load_config
+import numpy as np
+import threading
+import time
+
+config = load_config()
+retrieval_config = config.get("retrieval", {})
+
+RETRIEVAL_MODES = ("vector", "hybrid")
+
+# Latency of every retrieval stage in milliseconds, keyed by stage name
+retrieval_latencies = LatencyHistogram()
+
+_chunk_index_lock = threading.Lock()
+
+def reciprocal_rank_fusion(rankings, rrf_k=60):
+    """Fuses ranked lists of ids, an id ranked high in any list ends up high in the result."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+def maximal_marginal_relevance(query_vector, candidate_vectors, k, lambda_mult=0.7):
+    """Returns the indexes of k candidates that are similar to the query but not to each other."""
+    if not candidate_vectors:
+        return []
+    candidates = np.asarray(candidate_vectors, dtype=np.float32)
+    candidates /= np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_vector, dtype=np.float32)
+    query /= max(np.linalg.norm(query), 1e-12)
+    query_similarity = candidates @ query
+    selected = [int(np.argmax(query_similarity))]
+    while len(selected) < min(k, len(candidates)):
+        redundancy = (candidates @ candidates[selected].T).max(axis=1)
+        scores = lambda_mult * query_similarity - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        selected.append(int(np.argmax(scores)))
+    return selected
+
+def update_chunk_metadatas(vector_db, ids, metadatas):
+    """Replaces the metadata of stored chunks without embedding them again."""
+    if isinstance(vector_db, QuantizedVectorStore):
+        vector_db.update_metadatas(ids, metadatas)
+    else:
+        vector_db._collection.update(ids=ids, metadatas=metadatas)
+
+def migrate_chunk_index(vector_db, report_progress=None, batch_size=500):
+    """Registers the chunks indexed before documents were tracked, runs once per database.
+
+    Unregistered chunks of the vector store are registered as shared and their texts are added to the keyword index.
+    Chunks without a chat_history_id in their metadata are tagged as shared, so session filters match them,
+    and get their chunk_id, so hybrid search matches their vector and keyword results.
+    """
+    document_repo = db_manager.document_repo
+    with _chunk_index_lock:
+        if document_repo.is_chunk_index_migrated():
+            return
+        registered_chunk_ids = document_repo.get_registered_chunk_ids()
+        candidate_ids = [chunk_id for chunk_id in vector_db.get(include=[])["ids"] if chunk_id not in registered_chunk_ids]
+        registered = 0
+        tagged = 0
+        for start in range(0, len(candidate_ids), batch_size):
+            result = vector_db.get(ids=candidate_ids[start:start + batch_size], include=["documents", "metadatas"])
+            chunks = []
+            untagged_ids = []
+            untagged_metadatas = []
+            for chunk_id, content, metadata in zip(result["ids"], result["documents"], result["metadatas"]):
+                metadata = metadata or {}
+                chunks.append({"chunk_id": chunk_id,
+                               "document_name": metadata.get("source", ""),
+                               "page_number": metadata.get("page", 0),
+                               "chat_history_id": metadata.get("chat_history_id", DocumentRepository.SHARED_SCOPE),
+                               "content": content})
+                if "chat_history_id" not in metadata or "chunk_id" not in metadata:
+                    untagged_ids.append(chunk_id)
+                    untagged_metadatas.append({**metadata, "chunk_id": chunk_id, "chat_history_id": chunks[-1]["chat_history_id"]})
+            document_repo.register_chunks(chunks)
+            registered += len(chunks)
+            if untagged_ids:
+                update_chunk_metadatas(vector_db, untagged_ids, untagged_metadatas)
+                tagged += len(untagged_ids)
+            if report_progress:
+                report_progress(min(start + batch_size, len(candidate_ids)), len(candidate_ids))
+        document_repo.mark_chunk_index_migrated()
+        if registered:
+            print(f"Added {registered} chunks to the keyword index.")
+        if tagged:
+            print(f"Tagged {tagged} chunks as shared between sessions.")
+            mark_collection_changed()
+
+def migrate_chunk_index_job(context):
+    """Background job wrapper around migrate_chunk_index, started once when the app starts."""
+    def report_progress(chunks_done, total_chunks):
+        context.report_progress(chunks_done / max(total_chunks, 1), f"{chunks_done}/{total_chunks} chunks checked")
+    migrate_chunk_index(load_vectordb(), report_progress)
+
+def get_scope(chat_history_id):
+    """Sessions whose documents are searched, None searches all documents."""
+    if chat_history_id is None or retrieval_config.get("scope", "session") == "global":
+        return None
+    return [chat_history_id, DocumentRepository.SHARED_SCOPE]
+
+def similarity_search(vector_db, query_vector, k, scope):
+    start_time = time.perf_counter()
+    search_filter = {"chat_history_id": {"$in": scope}} if scope is not None else None
+    documents = vector_db.similarity_search_by_vector(query_vector, k=k, filter=search_filter)
+    retrieval_latencies.record("vector", (time.perf_counter() - start_time) * 1000)
+    return documents
+
+def hybrid_candidates(vector_db, query, query_vector, candidates, rrf_k, scope=None, document_repo=None):
+    """Ranks the union of the vector and bm25 results with reciprocal rank fusion."""
+    vector_results = similarity_search(vector_db, query_vector, candidates, scope)
+
+    start_time = time.perf_counter()
+    keyword_results = (document_repo or db_manager.document_repo).search_chunks(query, candidates, scope)
+    retrieval_latencies.record("keyword", (time.perf_counter() - start_time) * 1000)
+
+    documents = {}
+    vector_ranking = []
+    for document in vector_results:
+        chunk_id = document.metadata.get("chunk_id", document.page_content)
+        documents.setdefault(chunk_id, document)
+        vector_ranking.append(chunk_id)
+    keyword_ranking = []
+    for chunk in keyword_results:
+        documents.setdefault(chunk["chunk_id"], Document(page_content=chunk["content"],
+                                                         metadata={"source": chunk["document_name"],
+                                                                   "page": chunk["page_number"],
+                                                                   "chunk_id": chunk["chunk_id"],
+                                                                   "chat_history_id": chunk["chat_history_id"]}))
+        keyword_ranking.append(chunk["chunk_id"])
+    return [documents[chunk_id] for chunk_id in reciprocal_rank_fusion([vector_ranking, keyword_ranking], rrf_k)]
+
+def search_documents(vector_db, query, query_vector, k, mode=None, mmr=None, scope=None, document_repo=None):
+    """Returns k chunks for the query, mode and mmr default to the retrieval section of the config.
+
+    scope is the list of sessions whose documents are searched, all documents if it is None.
+    document_repo holds the keyword index of the vector store, the registry of the app by default.
+    """
+    mode = mode or retrieval_config.get("mode", "hybrid")
+    mmr = retrieval_config.get("mmr", False) if mmr is None else mmr
+    candidates = max(retrieval_config.get("candidates", 20), k)
+    if mode == "vector":
+        if not mmr:
+            return similarity_search(vector_db, query_vector, k, scope)
+        ranked = similarity_search(vector_db, query_vector, candidates, scope)
+    elif mode == "hybrid":
+        ranked = hybrid_candidates(vector_db, query, query_vector, candidates, retrieval_config.get("rrf_k", 60), scope,
+                                   document_repo)
+    else:
+        raise ValueError(f"Unknown retrieval mode: {mode}")
+    if not mmr:
+        return ranked[:k]
+    start_time = time.perf_counter()
+    # The chunk vectors come from the embedding cache, they were stored there when the pdf was ingested
+    candidate_vectors = vector_db.embeddings.embed_documents([document.page_content for document in ranked])
+    selected = maximal_marginal_relevance(query_vector, candidate_vectors, k, retrieval_config.get("mmr_lambda", 0.7))
+    retrieval_latencies.record("mmr", (time.perf_counter() - start_time) * 1000)
+    return [ranked[index] for index in selected]
+
+def retrieve_documents(query, k, chat_history_id=None):
+    """Returns k chunks for the query, reused from a similar recent query if possible.
+
+    With the session scope only documents uploaded in chat_history_id and shared documents are searched.
+    """
+    start_time = time.perf_counter()
+    vector_db = load_vectordb()
+    collection_name = config["chromadb"]["collection_name"]
+    # Read before searching, a concurrent ingestion then makes this entry stale instead of serving old results
+    version = get_collection_version(collection_name)
+    query_vector = vector_db.embeddings.embed_query(query)
+    scope = get_scope(chat_history_id)
+    scope_key = chat_history_id if scope is not None else None
+    documents = None
+    if semantic_cache is not None:
+        documents = semantic_cache.lookup(collection_name, version, query_vector, k, scope_key)
+        if documents is not None:
+            print(f"Semantic cache hit: {semantic_cache.stats()}")
+    if documents is None:
+        documents = search_documents(vector_db, query, query_vector, k, scope=scope)
+        if semantic_cache is not None:
+            semantic_cache.store(collection_name, version, query_vector, k, documents, scope_key)
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    retrieval_latencies.record("total", elapsed_ms)
+    print(f"Retrieved {len(documents)} chunks in {elapsed_ms:.1f} ms")
+    return documents
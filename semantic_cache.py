@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from utils import CacheStats
+from typing import List, Optional
+import numpy as np
+import threading
+
+class SemanticQueryCache(CacheStats):
+    """Remembers the retrieved chunks of recent queries and serves them to sufficiently similar queries.
+
+    Entries belong to a collection version, once the collection changes they are not served anymore.
+    """
+
+    def __init__(self, similarity_threshold: float = 0.95, max_entries: int = 256):
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._next_entry_id = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, collection_name: str, version: int, query_vector: List[float], k: int,
+               scope: Optional[str] = None) -> Optional[list]:
+        query = self._normalize(query_vector)
+        with self._lock:
+            best_entry_id, best_similarity = None, self.similarity_threshold
+            for entry_id, entry in list(self._entries.items()):
+                if entry["collection_name"] != collection_name:
+                    continue
+                if entry["version"] != version:
+                    del self._entries[entry_id]
+                    continue
+                if entry["k"] != k or entry["scope"] != scope or entry["vector"].shape != query.shape:
+                    continue
+                similarity = float(np.dot(entry["vector"], query))
+                if similarity >= best_similarity:
+                    best_entry_id, best_similarity = entry_id, similarity
+            if best_entry_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_entry_id)
+            self.hits += 1
+            return self._entries[best_entry_id]["documents"]
+
+    def store(self, collection_name: str, version: int, query_vector: List[float], k: int, documents: list,
+              scope: Optional[str] = None) -> None:
+        with self._lock:
+            self._entries[self._next_entry_id] = {
+                "collection_name": collection_name,
+                "version": version,
+                "vector": self._normalize(query_vector),
+                "k": k,
+                "scope": scope,
+                "documents": documents
+            }
+            self._next_entry_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, collection_name: Optional[str] = None) -> None:
+        with self._lock:
+            for entry_id, entry in list(self._entries.items()):
+                if collection_name in (None, entry["collection_name"]):
+                    del self._entries[entry_id]
+
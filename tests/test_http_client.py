@@ -0,0 +1,117 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http_client import HTTPClient
+import requests
+import threading
+import socket
+import pytest
+import json
+import time
+
+class StubModelServer(BaseHTTPRequestHandler):
+    """Answers like a model server, the behaviour is picked by the path."""
+
+    protocol_version = "HTTP/1.1" # keep-alive, so reused connections can be observed
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, body=None, headers=None):
+        payload = json.dumps(body or {}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _handle(self):
+        if self.headers.get("Content-Length"):
+            self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        with server.lock:
+            server.attempts[self.path] = server.attempts.get(self.path, 0) + 1
+            server.client_ports.append(self.client_address[1])
+            attempt = server.attempts[self.path]
+        if self.path == "/ok":
+            self._respond(200, {"attempt": attempt})
+        elif self.path == "/busy":
+            # Busy twice, then answers
+            if attempt <= 2:
+                self._respond(429 if attempt == 1 else 503, headers={"Retry-After": "0"})
+            else:
+                self._respond(200, {"attempt": attempt})
+        elif self.path == "/error":
+            self._respond(500, {"error": "model crashed"})
+        elif self.path == "/slow":
+            time.sleep(1)
+            self._respond(200)
+        else:
+            self._respond(404)
+
+    do_GET = _handle
+    do_POST = _handle
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubModelServer)
+    server.lock = threading.Lock()
+    server.attempts = {}
+    server.client_ports = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def client():
+    client = HTTPClient(connect_timeout=1, read_timeout=0.3, max_retries=3, backoff_factor=0)
+    yield client
+    client.close()
+
+def url(server, path):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+def test_connection_is_reused(server, client):
+    for _ in range(5):
+        assert client.post(url(server, "/ok"), json={"model": "llama3"}).status_code == 200
+    assert len(set(server.client_ports)) == 1
+
+def test_busy_responses_are_retried(server, client):
+    response = client.post(url(server, "/busy"), json={})
+    assert response.status_code == 200
+    assert server.attempts["/busy"] == 3
+
+def test_server_errors_are_not_retried(server, client):
+    response = client.post(url(server, "/error"), json={})
+    assert response.status_code == 500
+    assert server.attempts["/error"] == 1
+
+def test_read_timeout_is_not_retried(server, client):
+    start_time = time.perf_counter()
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.post(url(server, "/slow"), json={})
+    assert time.perf_counter() - start_time < 1
+    # Give the stub time to count a retried request, if one were sent
+    time.sleep(0.2)
+    assert server.attempts["/slow"] == 1
+
+def test_connection_errors_are_retried():
+    # A port nobody listens on
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+    client = HTTPClient(connect_timeout=1, read_timeout=1, max_retries=2, backoff_factor=0)
+    with pytest.raises(requests.exceptions.ConnectionError) as error:
+        client.get(f"http://127.0.0.1:{port}/api/tags")
+    assert "Max retries exceeded" in str(error.value)
+    client.close()
+
+def test_latencies_are_recorded_per_endpoint(server, client):
+    client.post(url(server, "/ok"), json={})
+    client.get(url(server, "/ok"))
+    stats = client.latency_stats()
+    host = f"127.0.0.1:{server.server_address[1]}"
+    assert stats[f"POST {host}/ok"]["count"] == 1
+    assert stats[f"GET {host}/ok"]["count"] == 1
@@ -1,12 +1,9 @@
 from datetime import datetime
 import base64
 import yaml
-import requests
+from http_client import HTTPClient
+from llm_dispatcher import LLMDispatcher
 from dotenv import load_dotenv
-import streamlit as st
-import os
-import aiohttp
-import asyncio
 import time
 load_dotenv()
 
@@ -17,6 +14,46 @@ def load_config(file_path = "config.yaml"):
     
 config = load_config()
 
+http_config = config.get("http", {})
+http_client = HTTPClient(connect_timeout=http_config.get("connect_timeout", 5),
+                         read_timeout=http_config.get("read_timeout", 600),
+                         pool_maxsize=http_config.get("pool_maxsize", 10),
+                         max_retries=http_config.get("max_retries", 3),
+                         backoff_factor=http_config.get("backoff_factor", 0.5))
+
+def lookup_by_prefix(name, values, default=None):
+    """Value of the longest key of values that name starts with, default if none matches.
+
+    Model names are matched by prefix, e.g. "llama3" covers "llama3:8b-instruct".
+    """
+    matches = [prefix for prefix in values if name.startswith(prefix)]
+    if not matches:
+        return default
+    return values[max(matches, key=len)]
+
+class CacheStats:
+    """Hit and miss counters of a cache, the cache counts them under its own lock."""
+
+    hits = 0
+    misses = 0
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / requests if requests else 0.0}
+
+dispatcher_config = config.get("llm_dispatcher", {})
+llm_dispatcher = LLMDispatcher(lambda model: lookup_by_prefix(model, dispatcher_config.get("max_in_flight") or {},
+                                                              dispatcher_config.get("max_in_flight_default", 1)),
+                               worker_threads=dispatcher_config.get("worker_threads", 16))
+
+def get_keep_alive(model):
+    """How long ollama keeps the model loaded after a request, per model by name prefix with ollama.keep_alive as default."""
+    ollama_config = config["ollama"]
+    return lookup_by_prefix(model, ollama_config.get("keep_alive_per_model") or {}, ollama_config.get("keep_alive", "5m"))
+
+def get_json(url, headers=None):
+    return http_client.get(url, headers=headers).json()
+
 
 def convert_ns_to_seconds(ns_value):
     return ns_value / 1_000_000_000 
@@ -32,92 +69,21 @@ def timeit(func):
     return wrapper
 
 def command(user_input):
+    """Returns the answer to a /command and the background job it requests, None if it requests none.
+
+    The job request has the job_type, the job args and what is remembered with the pending job.
+    """
     splitted_input = user_input.split(" ")
     if splitted_input[0] == "/pull":
-        return pull_model_in_background(splitted_input[1])
+        model_name = splitted_input[1]
+        return f"Pulling {model_name} in the background.", {"job_type": "pull_model", "args": [model_name], "model_name": model_name}
     elif splitted_input[0] == "/help":
-        return "Possible commands:\n- /pull <model_name>"
+        return "Possible commands:\n- /pull <model_name>", None
     else:    
         return """Invalid command, please use one of the following:\n
                     - /help\n
-                    - /pull <model_name>"""
+                    - /pull <model_name>""", None
 
-def pull_ollama_model(model_name):
-    json_response = requests.post(url = config["ollama"]["base_url"] + "/api/pull", json = {"model": model_name}).json()
-    print(json_response)
-    if "error" in json_response.keys():
-        return json_response["error"]["message"]
-    else:
-        st.session_state.model_options = list_ollama_models()
-        st.warning(f"Pulling {model_name} finished.")
-        return json_response
-
-async def pull_ollama_model_async(model_name, stream=True, retries=1):
-    url = config["ollama"]["base_url"] + "/api/pull"
-    json_data = {"model": model_name, "stream": stream}
-    
-    for attempt in range(retries):
-        try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=1800)) as session:  # Increased timeout for model pulling
-                async with session.post(url, json=json_data) as response:
-                    if stream:
-                        # Handle streaming response
-                        async for chunk in response.content.iter_chunked(1024):
-                            if chunk:
-                                st.info(f"Received chunk: {chunk.decode('utf-8')}")
-                    else:
-                        json_response = await response.json()
-                        print(json_response)
-
-                        if json_response.get("error", False):
-                            return json_response["error"]
-                        else:
-                            st.session_state.model_options = list_ollama_models()
-                            return f"Pull of {model_name} finished."
-                    return "Pulled"
-        except asyncio.TimeoutError:
-            st.warning(f"Timeout on attempt {attempt + 1}. Retrying...")
-        except Exception as e:
-            st.error(f"Error: {str(e)}")
-            break  # Break on non-timeout errors
-    return f"Failed to pull {model_name} after {retries} attempts."
-
-# Function to trigger the async pull (can be run in the event loop)
-def pull_model_in_background(model_name, stream=False):
-    try:
-        # Check if there's already an event loop running
-        loop = asyncio.get_running_loop()
-    except RuntimeError:  # If no loop is running, start a new one
-        loop = None
-
-    #st.info(f"Pulling {model_name}...")
-
-    if loop and loop.is_running():
-        # If an event loop is already running, create a task for the async function
-        return asyncio.create_task(pull_ollama_model_async(model_name, stream=stream))
-    else:
-        # Otherwise, use asyncio.run() to run it synchronously
-        return asyncio.run(pull_ollama_model_async(model_name, stream=stream))
-
-
-
-def list_openai_models():
-    openai_api_key = os.getenv("OPENAI_API_KEY")
-    response = requests.get("https://api.openai.com/v1/models", headers={"Authorization": f"Bearer {openai_api_key}"}).json()
-    if response.get("error", False):
-        st.warning("Openai Error: " + response["error"]["message"])
-        return []
-    else:
-        return [item["id"] for item in response["data"]]
-
-
-def list_ollama_models():
-    json_response = requests.get(url = config["ollama"]["base_url"] + "/api/tags").json()
-    if json_response.get("error", False):
-        return []
-    models = [model["name"] for model in json_response["models"] if "embed" not in model["name"]]
-    return models
-    
 def convert_bytes_to_base64(image_bytes):
     return base64.b64encode(image_bytes).decode("utf-8")
     
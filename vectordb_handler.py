@@ -1,20 +1,152 @@
 from langchain_chroma import Chroma
-from langchain_ollama import OllamaEmbeddings
-from utils import load_config
+from langchain_core.embeddings import Embeddings
+from embedding_cache import EmbeddingCache, CachedEmbeddings
+from semantic_cache import SemanticQueryCache
+from quantized_store import QuantizedVectorStore
+from local_embeddings import SentenceTransformerEmbeddings
+from utils import load_config, http_client, get_keep_alive
 import chromadb
+import threading
 
 config = load_config()
 
-def get_ollama_embeddings():
-    return OllamaEmbeddings(model=config["ollama"]["embedding_model"], base_url=config["ollama"]["base_url"])
+class OllamaHTTPEmbeddings(Embeddings):
+    """Ollama embeddings sent through the shared pooled http client."""
 
-def load_vectordb(embeddings=get_ollama_embeddings()):
-    persistent_client = chromadb.PersistentClient(config["chromadb"]["chromadb_path"])
+    def __init__(self, model, base_url, keep_alive=None):
+        self.model = model
+        self.base_url = base_url
+        self.keep_alive = keep_alive
 
-    langchain_chroma = Chroma(
-        client=persistent_client,
-        collection_name=config["chromadb"]["collection_name"],
-        embedding_function=embeddings,
-    )
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        data = {"model": self.model, "input": texts}
+        if self.keep_alive is not None:
+            data["keep_alive"] = self.keep_alive
+        response = http_client.post(url=self.base_url + "/api/embed", json=data)
+        json_response = response.json()
+        if "error" in json_response.keys():
+            raise RuntimeError("OLLAMA ERROR: " + json_response["error"])
+        return json_response["embeddings"]
 
-    return langchain_chroma
\ No newline at end of file
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+embedding_cache_config = config.get("embedding_cache", {})
+embedding_cache = None
+if embedding_cache_config.get("enabled", True):
+    embedding_cache = EmbeddingCache(embedding_cache_config.get("path", "./chat_sessions/embedding_cache.db"),
+                                     max_entries=embedding_cache_config.get("max_entries", 200000))
+
+embeddings_config = config.get("embeddings", {})
+
+def get_embedding_backend():
+    """The embeddings backend selected in the config, without the embedding cache."""
+    backend = embeddings_config.get("backend", "ollama")
+    if backend == "ollama":
+        return OllamaHTTPEmbeddings(model=config["ollama"]["embedding_model"], base_url=config["ollama"]["base_url"],
+                                    keep_alive=get_keep_alive(config["ollama"]["embedding_model"]))
+    if backend == "sentence_transformers":
+        return SentenceTransformerEmbeddings(**embeddings_config.get("sentence_transformers", {}))
+    raise ValueError(f"Unknown embeddings backend: {backend}")
+
+def get_embeddings():
+    embeddings = get_embedding_backend()
+    if embedding_cache is None:
+        return embeddings
+    return CachedEmbeddings(embeddings, embedding_cache)
+
+vector_store_config = config.get("vector_store", {})
+
+def get_hnsw_metadata():
+    """Chroma collection metadata for the configured hnsw parameters, M and construction_ef only apply to new collections."""
+    return {f"hnsw:{name}": value for name, value in vector_store_config.get("hnsw", {}).items()} or None
+
+class VectorStoreCache:
+    """Keeps one chroma client per path and one langchain store per (path, collection, embedding model)."""
+
+    def __init__(self):
+        self._clients = {}
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def get(self, chromadb_path, collection_name, embeddings, storage="chroma"):
+        """storage "quantized" returns a QuantizedVectorStore kept under chromadb_path instead of a chroma store."""
+        key = (chromadb_path, collection_name, getattr(embeddings, "model", type(embeddings).__name__))
+        with self._lock:
+            if key not in self._stores:
+                if storage == "quantized":
+                    self._stores[key] = QuantizedVectorStore(chromadb_path, collection_name, embeddings,
+                                                             rerank_candidates=vector_store_config.get("rerank_candidates", 50))
+                    return self._stores[key]
+                if chromadb_path not in self._clients:
+                    self._clients[chromadb_path] = chromadb.PersistentClient(chromadb_path)
+                self._stores[key] = Chroma(
+                    client=self._clients[chromadb_path],
+                    collection_name=collection_name,
+                    embedding_function=embeddings,
+                    collection_metadata=get_hnsw_metadata(),
+                )
+            return self._stores[key]
+
+    def invalidate(self, chromadb_path=None, collection_name=None):
+        """Drops cached stores matching the given path and collection, all of them if nothing is given."""
+        with self._lock:
+            for key in list(self._stores.keys()):
+                if chromadb_path not in (None, key[0]) or collection_name not in (None, key[1]):
+                    continue
+                del self._stores[key]
+            if collection_name is None:
+                for path in list(self._clients.keys()):
+                    if chromadb_path in (None, path):
+                        del self._clients[path]
+
+vector_store_cache = VectorStoreCache()
+
+semantic_cache_config = config.get("semantic_cache", {})
+semantic_cache = None
+if semantic_cache_config.get("enabled", True):
+    semantic_cache = SemanticQueryCache(similarity_threshold=semantic_cache_config.get("similarity_threshold", 0.95),
+                                        max_entries=semantic_cache_config.get("max_entries", 256))
+
+# Bumped whenever chunks are added to or deleted from a collection, cached retrievals of older versions are stale
+collection_versions = {}
+collection_versions_lock = threading.Lock()
+
+def get_collection_version(collection_name):
+    with collection_versions_lock:
+        return collection_versions.get(collection_name, 0)
+
+def mark_collection_changed(collection_name=None):
+    collection_name = collection_name or config["chromadb"]["collection_name"]
+    with collection_versions_lock:
+        collection_versions[collection_name] = collection_versions.get(collection_name, 0) + 1
+    if semantic_cache is not None:
+        semantic_cache.invalidate(collection_name)
+
+def get_vectordb_path():
+    if vector_store_config.get("storage", "chroma") == "quantized":
+        return vector_store_config.get("quantized_path", "quantized_index")
+    return config["chromadb"]["chromadb_path"]
+
+def load_vectordb(embeddings=get_embeddings()):
+    return vector_store_cache.get(get_vectordb_path(),
+                                  config["chromadb"]["collection_name"],
+                                  embeddings,
+                                  storage=vector_store_config.get("storage", "chroma"))
+
+def invalidate_vectordb(collection_name=None):
+    vector_store_cache.invalidate(get_vectordb_path(), collection_name)
+    if collection_name is None:
+        with collection_versions_lock:
+            names = list(collection_versions.keys()) or [config["chromadb"]["collection_name"]]
+        for name in names:
+            mark_collection_changed(name)
+    else:
+        mark_collection_changed(collection_name)
+
+def warmup_embeddings():
+    """Loads the embedding model of the vector store before the first pdf question, the embedding cache is bypassed."""
+    embeddings = load_vectordb().embeddings
+    getattr(embeddings, "embeddings", embeddings).embed_query("warmup")